@@ -0,0 +1,167 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+"""Benchmark of parsers of Dropbox pages on generated shares of different size.
+Reports time of feeding page by chunks, time spent in _process_filelink, entries per second
+and peak memory of parsing. Each run is made in its own process, so peaks don't affect each other.
+
+Usage: bench_parsers.py [--sizes 100 10000 100000] [--parsers html fast]
+"""
+from __future__ import unicode_literals
+
+import argparse
+import cgi
+import random
+import resource
+import string
+import sys
+import time
+import urllib
+import zlib
+from multiprocessing import Process, Queue
+
+from parsers import PARSERS
+
+__author__ = "Nakoryakov Aleksey, Sysoev Roman"
+__maintainer__ = "Nakoryakov Aleksey"
+__license__ = "GPL 3.0"
+
+
+SHARE_URL = 'https://www.dropbox.com/sh/3aycxk7war34ijo/AADeK2sC0IwbNEUtPnXXaOura'
+WORDS = ['game', 'Final Fantasy', 'Тетрис', 'ドラゴン', 'bios', 'save & load', '100%', 'naïve', 'ROM #2', 'x+y']
+EXTENSIONS = ['.zip', '.bin', '.iso', '.opk', '.txt', '']
+KEY_CHARACTERS = string.ascii_letters + string.digits + '-_'
+# Heavy head of real page: styles and scripts mentioning classes of links
+PAGE_HEAD = ('<!DOCTYPE html><html><head><title>Dropbox</title>'
+             '<style>.file-link{color:#007ee5}.folder-link{color:#007ee5}' + '.sl-row{margin:0}' * 200 +
+             '</style><script>var config = {"classes": "<a class=\\"file-link\\">"};' + 'var x = 1;' * 2000 +
+             '</script></head><body><div class="sl-list">')
+PAGE_FOOT = '<!-- <a class="file-link" href="https://example.com/commented?dl=0"> --></div></body></html>'
+
+
+def make_name(number, rnd):
+    return '{} {}{}'.format(rnd.choice(WORDS), number, rnd.choice(EXTENSIONS))
+
+
+def make_key(rnd):
+    """Key of file in share, every link has its own one, like /sh/<share>/<key>/<name> of real pages"""
+    return ''.join(rnd.choice(KEY_CHARACTERS) for _ in xrange(25))
+
+
+def make_page(count, seed=0):
+    """Page of shared folder with count file links and some folder links. utf-8 encoded.
+    Names are percent-encoded in links and shown as they are, like in real pages"""
+    rnd = random.Random(seed)
+    parts = [PAGE_HEAD]
+    for number in xrange(count):
+        name = make_name(number, rnd)
+        quoted = urllib.quote(name.encode('utf-8'))
+        if number % 50 == 49:
+            parts.append('<div class="sl-row"><a class="folder-link sl-link" href="{}/{}/{}?dl=0">'
+                         'folder</a></div>'.format(SHARE_URL, make_key(rnd), quoted))
+        parts.append('<div class="sl-row" data-id="{0}"><span class="sl-icon"></span>'
+                     '<a class="file-link sl-file-link" href="{1}/{2}/{3}?dl=0" data-size="{0}">'
+                     '<span class="sl-name">{4}</span></a><span class="sl-date">2016-05-05</span></div>'
+                     .format(number, SHARE_URL, make_key(rnd), quoted, cgi.escape(name)))
+    parts.append(PAGE_FOOT)
+    return ''.join(parts).encode('utf-8')
+
+
+def _memory_status(field):
+    """Field of /proc/self/status in KiB or None if it is not available"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def reset_peak_memory():
+    """Start measuring peak memory from now.
+    :return: function giving growth of peak memory since reset in KiB
+    """
+    try:
+        # Linux resets peak resident size of process by this
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        baseline = _memory_status('VmRSS')
+        return lambda: _memory_status('VmHWM') - baseline
+    except IOError:
+        # Peak of whole process life is all that is known
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+
+
+def measure(parser_name, size, chunk_size, results):
+    """Generate page and parse it in current process. Measurements are put to results queue"""
+    page = make_page(size)
+    parser_class = PARSERS[parser_name]
+    spent = [0.0]
+    process_filelink = parser_class._process_filelink
+
+    def timed_process_filelink(self, href):
+        started = time.time()
+        process_filelink(self, href)
+        spent[0] += time.time() - started
+
+    parser_class._process_filelink = timed_process_filelink
+    peak_memory = reset_peak_memory()
+    started = time.time()
+    parser = parser_class(SHARE_URL)
+    for start in xrange(0, len(page), chunk_size):
+        parser.feed(page[start:start + chunk_size])
+    parser.close()
+    elapsed = time.time() - started
+    memory = peak_memory()
+    # Parsers are compared by checksum of all found links, not only by their count
+    checksum = 0
+    for name, link in list(parser.data) + parser.folders:
+        checksum = zlib.crc32('{}\0{}\0'.format(name, link).encode('utf-8'), checksum)
+    results.put((len(page), len(parser.data), len(parser.folders), checksum, elapsed, spent[0], memory))
+
+
+def run(parser_name, size, chunk_size):
+    """Measure parser in separate process.
+    :return: tuple (size of page, files, folders, checksum of links, seconds of feeding,
+                    seconds in _process_filelink, peak memory in KiB)
+    """
+    results = Queue()
+    process = Process(target=measure, args=(parser_name, size, chunk_size, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark of parsers of Dropbox pages")
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000],
+                            help="counts of file links in generated pages")
+    arg_parser.add_argument('--parsers', nargs='+', default=['html', 'fast'], choices=['html', 'fast'],
+                            help="parsers to measure")
+    arg_parser.add_argument('--chunk-size', type=int, default=65536, help="size of chunks page is fed by")
+    args = arg_parser.parse_args()
+
+    print("{:>8} {:>6} {:>10} {:>8} {:>10} {:>12} {:>10}".format(
+        "links", "parser", "page, KiB", "feed, s", "links, s", "links/s", "peak, KiB"))
+    is_identical = True
+    for size in args.sizes:
+        found = {}
+        for parser_name in args.parsers:
+            page_size, files, folders, checksum, elapsed, in_links, memory = run(parser_name, size,
+                                                                                 args.chunk_size)
+            found[parser_name] = (files, folders, checksum)
+            print("{:>8} {:>6} {:>10} {:>8.3f} {:>10.3f} {:>12.0f} {:>10}".format(
+                files, parser_name, page_size // 1024, elapsed, in_links, files / elapsed if elapsed else 0,
+                memory))
+        if len(set(found.values())) > 1:
+            print("Parsers found different links (files, folders, checksum): {}".format(found))
+            is_identical = False
+    if not is_identical:
+        sys.exit("Results of parsers differ")
+
+
+if __name__ == '__main__':
+    main()
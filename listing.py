@@ -0,0 +1,121 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+from array import array
+from collections import namedtuple
+
+__author__ = "Nakoryakov Aleksey, Sysoev Roman"
+__maintainer__ = "Nakoryakov Aleksey"
+__license__ = "GPL 3.0"
+
+
+FileInfo = namedtuple('FileInfo', 'filename link')
+# Subfolder of shared folder. Name is a single path component
+FolderInfo = namedtuple('FolderInfo', 'name link')
+# Difference between two snapshots of filelist. Sets of filenames
+ListingDiff = namedtuple('ListingDiff', 'added removed changed')
+
+
+class Listing(object):
+    """Compact list of fileinfos for shares with many thousands of files.
+    Strings are kept utf-8 encoded in shared buffers and addressed by arrays of offsets.
+    Longest common beginning of all links, like address of share, is kept once, and links are kept
+    as tails after it. Behaves like list of FileInfo, fileinfos are created on access"""
+
+    def __init__(self, file_infos=()):
+        """
+        :param file_infos: iterable of tuples (filename, link) to fill listing by
+        """
+        self._prefix = None
+        self._names = bytearray()
+        self._name_ends = array(b'I')
+        self._tails = bytearray()
+        self._tail_ends = array(b'I')
+        self.extend(file_infos)
+
+    def append(self, file_info):
+        filename, link = file_info
+        link = _encode(link)
+        if self._prefix is None:
+            # Links of the same page usually differ only after last slash
+            self._prefix = link[:link.rfind(b'/') + 1]
+        elif not link.startswith(self._prefix):
+            self._shorten_prefix(os.path.commonprefix([self._prefix, link]))
+        self._names.extend(_encode(filename))
+        self._name_ends.append(len(self._names))
+        self._tails.extend(link[len(self._prefix):])
+        self._tail_ends.append(len(self._tails))
+
+    def extend(self, file_infos):
+        for file_info in file_infos:
+            self.append(file_info)
+
+    def _shorten_prefix(self, prefix):
+        """Move end of common prefix to beginning of every tail. It happens once per few different
+        beginnings of links, like per Dropbox share, as prefix only shortens"""
+        moved = self._prefix[len(prefix):]
+        tails = bytearray()
+        tail_ends = array(b'I')
+        start = 0
+        for end in self._tail_ends:
+            tails.extend(moved)
+            tails.extend(self._tails[start:end])
+            tail_ends.append(len(tails))
+            start = end
+        self._prefix, self._tails, self._tail_ends = prefix, tails, tail_ends
+
+    def _item(self, position):
+        name_start = self._name_ends[position - 1] if position else 0
+        tail_start = self._tail_ends[position - 1] if position else 0
+        filename = self._names[name_start:self._name_ends[position]].decode('utf-8')
+        # Prefix may end in the middle of utf-8 sequence, so link is decoded as a whole
+        link = (self._prefix + self._tails[tail_start:self._tail_ends[position]]).decode('utf-8')
+        return FileInfo(filename, link)
+
+    def __len__(self):
+        return len(self._name_ends)
+
+    def __iter__(self):
+        for position in xrange(len(self)):
+            yield self._item(position)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._item(position) for position in xrange(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("Listing index out of range")
+        return self._item(key)
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return 'Listing({!r})'.format(list(self))
+
+
+def diff_listings(previous, current):
+    """Compare two snapshots of filelist. Size of file is compared only if it is known in both
+    :param previous: dict filename -> size or None
+    :param current: dict filename -> size or None
+    :return: ListingDiff
+    """
+    added = set(filename for filename in current if filename not in previous)
+    removed = set(filename for filename in previous if filename not in current)
+    changed = set(filename for filename, size in current.iteritems()
+                  if size is not None and previous.get(filename, size) not in (None, size))
+    return ListingDiff(added, removed, changed)
+
+
+def _encode(text):
+    return text.encode('utf-8') if isinstance(text, unicode) else text
@@ -4,25 +4,33 @@ from __future__ import unicode_literals
 
 import abc
 import logging
+import re
 import urllib2
+import urlparse
 from HTMLParser import HTMLParser
-from collections import namedtuple
+
+from listing import FileInfo, FolderInfo, Listing
 
 __author__ = "Nakoryakov Aleksey, Sysoev Roman"
 __maintainer__ = "Nakoryakov Aleksey"
 __license__ = "GPL 3.0"
 
 
-FileInfo = namedtuple('FileInfo', 'filename link')
-
-
 class BaseParser(HTMLParser, object):
-    """Base parser. Stores parsed result in data property as list of tuples (filename, link)"""
+    """Base parser. Stores parsed result in data property as Listing of tuples (filename, link)
+    and found subfolders in folders property as list of tuples (name, link)"""
     __metaclass__ = abc.ABCMeta
+    # Kind of pages parser understands. Parsers of the same kind give the same result for a page
+    PAGE_FORMAT = None
 
-    def __init__(self):
+    def __init__(self, base_url=None):
+        """
+        :param base_url: url of page, relative links are resolved against it
+        """
         super(BaseParser, self).__init__()
-        self._data = []
+        self.base_url = base_url
+        self._data = Listing()
+        self._folders = []
 
     def __enter__(self):
         return self
@@ -35,24 +43,262 @@ class BaseParser(HTMLParser, object):
         """List of fileinfos. (filename, link)"""
         return self._data
 
+    @property
+    def folders(self):
+        """List of folderinfos. (name, link)"""
+        return self._folders
+
+    def looks_valid(self):
+        """Check that result is plausible. Result of parser which doesn't understand page may be not"""
+        return True
+
+    def feed_stream(self, stream, chunk_size=65536):
+        """Feed parser by chunks as they are read from stream, so whole page is never kept in memory.
+        Generator, yields fileinfos as soon as they are found. They are collected to data as well
+        :param stream: file-like object to read page from
+        :param chunk_size: size of chunks to read
+        """
+        yielded = 0
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            self.feed(chunk)
+            for file_info in self._data[yielded:]:
+                yield file_info
+            yielded = len(self._data)
+        self.close()
+        for file_info in self._data[yielded:]:
+            yield file_info
+
+
+def _unquote_name(href):
+    """Decoded last path component of href"""
+    escaped_name = href.split('/')[-1].rsplit('?', 1)[0]
+    if isinstance(escaped_name, unicode):
+        # HTMLParser may give unicode, but unquoted bytes must be decoded as utf-8 by us
+        escaped_name = escaped_name.encode('utf-8')
+    return urllib2.unquote(escaped_name).decode('utf-8')
+
+
+def is_safe_name(name):
+    """Check that name can't lead out of folder it belongs to"""
+    return name not in ('', '.', '..') and '/' not in name and '\\' not in name
+
 
 class DropboxParser(BaseParser):
+    PAGE_FORMAT = 'dropbox'
+
     def handle_starttag(self, tag, attrs):
         if tag != 'a':
             return
-        is_found_link = False
+        link_class = ''
         href = ''
         for name, value in attrs:
-            if name == 'class' and 'file-link' in value:
-                is_found_link = True
+            if name == 'class':
+                link_class = value or ''
             elif name == 'href':
                 href = value
-        if is_found_link and href:
+        if not href:
+            return
+        # Folder is checked first, its classes may contain file-link too
+        if 'folder-link' in link_class:
+            logging.debug("Found folder: %s", href)
+            self._process_folderlink(href)
+        elif 'file-link' in link_class:
             logging.debug("Found link: %s", href)
             self._process_filelink(href)
 
     def _process_filelink(self, href):
-        escaped_fname = href.split('/')[-1].rsplit('?', 1)[0]
+        name = _unquote_name(href)
+        if not is_safe_name(name):
+            logging.warning("Link with unsafe name is skipped: %s", href)
+            return
         url = href.rstrip('0') + '1'
-        file_info = FileInfo(urllib2.unquote(escaped_fname).decode('utf-8'), url)
-        self._data.append(file_info)
+        self._data.append(FileInfo(name, url))
+
+    def _process_folderlink(self, href):
+        name = _unquote_name(href)
+        if is_safe_name(name):
+            self._folders.append(FolderInfo(name, href))
+
+
+class FastDropboxParser(DropboxParser):
+    """Finds the same links as DropboxParser, but scans raw page by regular expressions instead of
+    tokenizing every tag and attribute. Only anchors, comments, scripts and styles are recognized,
+    so result should be checked by looks_valid.
+    Page is scanned as utf-8 bytes, only anchors are decoded"""
+    # Quoted values of attributes may contain '>'
+    TOKEN = re.compile(br'''<a\s(?:"[^"]*"|'[^']*'|[^'">])*>|<!--|<script\b|<style\b''', re.IGNORECASE)
+    ANCHOR_START = re.compile(br'<a(?:\s|\Z)', re.IGNORECASE)
+    ATTRIBUTE = re.compile(r'''([^\s"'>/=]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''')
+    # Content of these is skipped until closing string is found
+    CLOSING = {b'<!--': re.compile(br'-->'),
+               b'<script': re.compile(br'</script\s*>', re.IGNORECASE),
+               b'<style': re.compile(br'</style\s*>', re.IGNORECASE)}
+    MARKER = b'file-link'
+
+    def __init__(self, base_url=None):
+        super(FastDropboxParser, self).__init__(base_url)
+        self._buffer = b''
+        self._closing = None
+        # Mentions of file links outside comments, scripts and styles and links found by them
+        self._markers = 0
+        self._marked_links = 0
+
+    def feed(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._buffer += data
+        self._scan(is_final=False)
+
+    def close(self):
+        self._scan(is_final=True)
+        super(FastDropboxParser, self).close()
+
+    def looks_valid(self):
+        """Result is wrong if page mentions file links outside of scripts more times than links were found,
+        so some anchors weren't recognized, or if some name is empty"""
+        if self._markers > self._marked_links:
+            return False
+        return all(file_info.filename for file_info in self._data)
+
+    def _scan(self, is_final):
+        """Process complete tokens of buffer. Incomplete tail is kept until next chunk comes"""
+        buf = self._buffer
+        position = 0
+        while True:
+            if self._closing is not None:
+                match = self._closing.search(buf, position)
+                if match is None:
+                    # Part of closing string may be at the end
+                    position = max(position, len(buf) - 16)
+                    break
+                position = match.end()
+                self._closing = None
+                continue
+            match = self.TOKEN.search(buf, position)
+            if match is None:
+                tail = -1 if is_final else self._unfinished_token(buf, position)
+                end = len(buf) if tail == -1 else tail
+                self._markers += buf.count(self.MARKER, position, end)
+                position = end
+                break
+            token = match.group()
+            if token.startswith((b'<a', b'<A')):
+                self._markers += buf.count(self.MARKER, position, match.start())
+                self._process_anchor(token)
+            else:
+                self._markers += buf.count(self.MARKER, position, match.start())
+                self._closing = self.CLOSING[token.lower()]
+            position = match.end()
+        self._buffer = b'' if is_final else buf[position:]
+
+    def _unfinished_token(self, buf, position):
+        """Position where token, which may be completed by next chunk, starts or -1.
+        Anchor is unfinished if it starts after position, as no complete token is there.
+        Beginning of other tokens may be only in the last bytes"""
+        anchor = self.ANCHOR_START.search(buf, position)
+        if anchor is not None:
+            return anchor.start()
+        return buf.find(b'<', max(position, len(buf) - len(b'<script')))
+
+    def _process_anchor(self, tag):
+        is_marked = self.MARKER in tag
+        if is_marked:
+            self._markers += 1
+        tag = tag.decode('utf-8', 'replace')
+        attrs = dict((name.lower(), double or single or bare)
+                     for name, double, single, bare in self.ATTRIBUTE.findall(tag))
+        link_class = attrs.get('class', '')
+        href = self.unescape(attrs['href']) if attrs.get('href') else ''
+        if not href:
+            return
+        if 'folder-link' in link_class:
+            self._process_folderlink(href)
+        elif 'file-link' in link_class:
+            self._process_filelink(href)
+        else:
+            return
+        if is_marked:
+            # Link is counted even if its name is unsafe and it is skipped
+            self._marked_links += 1
+
+
+class ComparingParser(BaseParser):
+    """Parses page by given parser and by DropboxParser at once, result of DropboxParser is used.
+    Differences are logged, so other parser can be checked on real pages"""
+    PAGE_FORMAT = DropboxParser.PAGE_FORMAT
+
+    def __init__(self, parser_class, base_url=None):
+        """
+        :param parser_class: class of parser to check
+        """
+        super(ComparingParser, self).__init__(base_url)
+        self._checked = parser_class(base_url)
+        self._reference = DropboxParser(base_url)
+        self._data = self._reference.data
+        self._folders = self._reference.folders
+        self.is_identical = None
+
+    def feed(self, data):
+        self._checked.feed(data)
+        self._reference.feed(data)
+
+    def close(self):
+        self._checked.close()
+        self._reference.close()
+        if self.is_identical is not None:
+            return
+        self.is_identical = self._checked.data == self._data and self._checked.folders == self._folders
+        if not self.is_identical:
+            logging.warning("%s found %d files and %d folders, DropboxParser found %d files and %d folders",
+                            type(self._checked).__name__, len(self._checked.data), len(self._checked.folders),
+                            len(self._data), len(self._folders))
+
+
+class AutoindexParser(BaseParser):
+    """Parser of directory listings generated by Apache mod_autoindex or nginx autoindex.
+    Every link to an entry of listed directory is taken, links ending with slash are subfolders.
+    Links to parent directory, to other sites and for sorting of listing are skipped"""
+    PAGE_FORMAT = 'autoindex'
+
+    def __init__(self, base_url=None):
+        super(AutoindexParser, self).__init__(base_url)
+        parts = urlparse.urlsplit(base_url or '')
+        # Path of directory must end with slash, otherwise its entries are resolved against its parent
+        path = parts.path if parts.path.endswith('/') else parts.path + '/'
+        self._directory = urlparse.urlunsplit((parts.scheme, parts.netloc, path, '', ''))
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            return
+        href = dict(attrs).get('href')
+        if not href or href.startswith(('?', '#')):
+            return
+        link = urlparse.urljoin(self._directory, href)
+        if not link.startswith(self._directory):
+            return
+        entry = link[len(self._directory):]
+        is_folder = entry.endswith('/')
+        entry = entry.rstrip('/')
+        if not entry or '/' in entry or '?' in entry or '#' in entry:
+            return
+        name = _unquote_name(entry)
+        if not is_safe_name(name):
+            return
+        if is_folder:
+            logging.debug("Found folder: %s", link)
+            self._folders.append(FolderInfo(name, link))
+        else:
+            logging.debug("Found link: %s", link)
+            self._data.append(FileInfo(name, link))
+
+
+def page_format(parser_factory):
+    """PAGE_FORMAT of parsers made by factory, which is parser class or partial of it"""
+    return getattr(parser_factory, 'func', parser_factory).PAGE_FORMAT
+
+
+# Parsers of pages by names used in settings
+PARSERS = {'html': DropboxParser, 'fast': FastDropboxParser, 'autoindex': AutoindexParser}
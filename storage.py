@@ -0,0 +1,330 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from listing import FolderInfo, Listing
+
+__author__ = "Nakoryakov Aleksey, Sysoev Roman"
+__maintainer__ = "Nakoryakov Aleksey"
+__license__ = "GPL 3.0"
+
+
+# Parsed filelist and subfolders together with validators of the page they were parsed from
+# Page format is PAGE_FORMAT of parser, result of other parser isn't used
+CachedListing = namedtuple('CachedListing', 'etag last_modified file_infos folders page_format')
+
+# State of file in download directory. Status is one of STATUS_* below
+LocalFile = namedtuple('LocalFile', 'path size mtime digest status')
+STATUS_COMPLETE = 'complete'
+STATUS_PARTIAL = 'partial'
+# File is in place, but its size differs from size of remote file
+STATUS_INCOMPLETE = 'incomplete'
+
+
+class MetadataIndex(object):
+    """SQLite database with everything zinc knows about remote and local files, so it is not
+    rebuilt from scratch on every run. Connection is shared by threads, so access is serialized"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS listings (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            fetched REAL,
+            page_format TEXT
+        );
+        CREATE TABLE IF NOT EXISTS remote_files (
+            listing_url TEXT,
+            position INTEGER,
+            filename TEXT,
+            link TEXT,
+            PRIMARY KEY (listing_url, position)
+        );
+        CREATE TABLE IF NOT EXISTS remote_folders (
+            listing_url TEXT,
+            position INTEGER,
+            name TEXT,
+            link TEXT,
+            PRIMARY KEY (listing_url, position)
+        );
+        CREATE TABLE IF NOT EXISTS remote_info (
+            link TEXT PRIMARY KEY,
+            size INTEGER,
+            last_modified REAL
+        );
+        CREATE TABLE IF NOT EXISTS snapshots (
+            repo TEXT,
+            filename TEXT,
+            size INTEGER,
+            PRIMARY KEY (repo, filename)
+        );
+        CREATE TABLE IF NOT EXISTS manifest (
+            repo TEXT,
+            filename TEXT,
+            size INTEGER,
+            digest TEXT,
+            PRIMARY KEY (repo, filename)
+        );
+        CREATE TABLE IF NOT EXISTS usage (
+            path TEXT PRIMARY KEY,
+            repo TEXT,
+            last_used REAL
+        );
+        CREATE TABLE IF NOT EXISTS local_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            digest TEXT,
+            status TEXT
+        );
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to database file
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.executescript(self.SCHEMA)
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(listings)')]
+            if 'page_format' not in columns:
+                # Index of older version. Its listings have no format, so they are fetched again
+                self._connection.execute('ALTER TABLE listings ADD COLUMN page_format TEXT')
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def _query_many(self, sql, values, chunk_size=500):
+        """Run query with 'IN (...)' for values by chunks, SQLite limits count of parameters"""
+        rows = []
+        values = list(values)
+        with self._lock:
+            for start in xrange(0, len(values), chunk_size):
+                chunk = values[start:start + chunk_size]
+                query = sql.format(','.join('?' * len(chunk)))
+                rows.extend(self._connection.execute(query, chunk).fetchall())
+        return rows
+
+    def load_listing(self, url):
+        """CachedListing of filelist url or None if it was never saved"""
+        rows = self._query('SELECT etag, last_modified, page_format FROM listings WHERE url = ?', (url,))
+        if not rows:
+            return None
+        file_infos = Listing(self._query(
+            'SELECT filename, link FROM remote_files WHERE listing_url = ? ORDER BY position', (url,)))
+        folders = [FolderInfo(name, link) for name, link in self._query(
+            'SELECT name, link FROM remote_folders WHERE listing_url = ? ORDER BY position', (url,))]
+        return CachedListing(rows[0][0], rows[0][1], file_infos, folders, rows[0][2])
+
+    def save_listing(self, url, etag, last_modified, file_infos, folders=(), page_format=None):
+        """Replace saved filelist and subfolders of url in one transaction"""
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)',
+                                     (url, etag, last_modified, time.time(), page_format))
+            self._connection.execute('DELETE FROM remote_files WHERE listing_url = ?', (url,))
+            self._connection.executemany('INSERT INTO remote_files VALUES (?, ?, ?, ?)',
+                                         ((url, position, filename, link)
+                                          for position, (filename, link) in enumerate(file_infos)))
+            self._connection.execute('DELETE FROM remote_folders WHERE listing_url = ?', (url,))
+            self._connection.executemany('INSERT INTO remote_folders VALUES (?, ?, ?, ?)',
+                                         ((url, position, name, link)
+                                          for position, (name, link) in enumerate(folders)))
+
+    def remote_infos(self, links):
+        """Saved sizes and modification times of remote files.
+        :return: dict link -> tuple (size, last_modified)
+        """
+        rows = self._query_many('SELECT link, size, last_modified FROM remote_info WHERE link IN ({})', links)
+        return dict((link, (size, last_modified)) for link, size, last_modified in rows)
+
+    def save_remote_infos(self, infos):
+        """Save sizes and modification times of remote files in one transaction
+        :param infos: iterable of tuples (link, size, last_modified)
+        """
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO remote_info VALUES (?, ?, ?)', infos)
+
+    def forget_remote_infos(self, links):
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM remote_info WHERE link = ?',
+                                         ((link,) for link in links))
+
+    def load_snapshot(self, repo):
+        """Filelist of repo as it was seen last time.
+        :return: dict filename -> size or None if repo was never seen
+        """
+        rows = self._query('SELECT filename, size FROM snapshots WHERE repo = ?', (repo,))
+        return dict(rows) if rows else None
+
+    def save_snapshot(self, repo, sizes):
+        """Replace saved filelist of repo in one transaction
+        :param sizes: dict filename -> size or None
+        """
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM snapshots WHERE repo = ?', (repo,))
+            self._connection.executemany('INSERT INTO snapshots VALUES (?, ?, ?)',
+                                         ((repo, filename, size) for filename, size in sizes.iteritems()))
+
+    def manifest(self, repo):
+        """Digests of files downloaded from repo.
+        :return: dict filename -> tuple (size, digest)
+        """
+        rows = self._query('SELECT filename, size, digest FROM manifest WHERE repo = ?', (repo,))
+        return dict((filename, (size, digest)) for filename, size, digest in rows)
+
+    def save_manifest(self, repo, entries):
+        """Save digests of files downloaded from repo in one transaction
+        :param entries: iterable of tuples (filename, size, digest)
+        """
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)',
+                                         ((repo,) + tuple(entry) for entry in entries))
+
+    def local_files(self, paths):
+        """Known state of local files.
+        :return: dict path -> LocalFile
+        """
+        rows = self._query_many('SELECT path, size, mtime, digest, status FROM local_files '
+                                'WHERE path IN ({})', paths)
+        return dict((row[0], LocalFile(*row)) for row in rows)
+
+    def save_local_files(self, local_files):
+        """Save state of local files in one transaction
+        :param local_files: iterable of LocalFile
+        """
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO local_files VALUES (?, ?, ?, ?, ?)',
+                                         local_files)
+
+    def forget_local_files(self, paths):
+        paths = list(paths)
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM local_files WHERE path = ?',
+                                         ((path,) for path in paths))
+            self._connection.executemany('DELETE FROM usage WHERE path = ?', ((path,) for path in paths))
+
+    def usage(self):
+        """Repos and times of last use of downloaded files.
+        :return: dict path -> tuple (repo, last_used)
+        """
+        rows = self._query('SELECT path, repo, last_used FROM usage')
+        return dict((path, (repo, last_used)) for path, repo, last_used in rows)
+
+    def save_usage(self, entries):
+        """Save repos and times of last use of files in one transaction
+        :param entries: iterable of tuples (path, repo, last_used)
+        """
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO usage VALUES (?, ?, ?)', entries)
+
+
+class ListingCache(object):
+    """Parsed filelists saved in metadata index. Validators of page are kept with them,
+    so page is requested again only if it was changed"""
+
+    def __init__(self, index):
+        """
+        :param index: MetadataIndex to keep filelists in
+        """
+        self._index = index
+
+    def load(self, url, page_format):
+        """CachedListing of url or None if there is nothing cached or it was parsed as page of other format"""
+        cached = self._index.load_listing(url)
+        if cached is not None and cached.page_format != page_format:
+            logging.debug("Cached filelist of %s is parsed as %s page, not %s", url, cached.page_format,
+                          page_format)
+            return None
+        return cached
+
+    def save(self, url, page_format, etag, last_modified, file_infos, folders=()):
+        """Save filelist and subfolders of url parsed as page of page_format"""
+        self._index.save_listing(url, etag, last_modified, file_infos, folders, page_format)
+        logging.debug("Filelist of %s is cached", url)
+
+    @staticmethod
+    def conditional_headers(cached):
+        """Headers for request, which is answered by 304 if page is not changed since it was cached"""
+        headers = {}
+        if cached and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        return headers
+
+
+class LocalInventory(object):
+    """Sizes and modification times of all files under download directory. Directory is scanned once,
+    when files are asked first time, and then inventory is kept up to date by refresh of files zinc changes"""
+
+    def __init__(self, root):
+        """
+        :param root: download directory
+        """
+        self.root = root.decode('utf-8') if isinstance(root, bytes) else root
+        self._files = None
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        started = time.time()
+        files = {}
+        for directory, _, filenames in os.walk(self.root):
+            relative = os.path.relpath(directory, self.root)
+            for filename in filenames:
+                try:
+                    stat = os.stat(os.path.join(directory, filename))
+                except OSError:
+                    continue
+                name = filename if relative == '.' else os.path.join(relative, filename)
+                files[name] = (stat.st_size, stat.st_mtime)
+        logging.debug("Found %d files in %s in %.2fs", len(files), self.root, time.time() - started)
+        return files
+
+    @property
+    def files(self):
+        """dict name relative to root -> tuple (size, mtime)"""
+        with self._lock:
+            if self._files is None:
+                self._files = self._scan()
+            return self._files
+
+    def get(self, name):
+        """Tuple (size, mtime) of file or None if there is no such file"""
+        return self.files.get(name)
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def items(self):
+        """List of tuples (name, (size, mtime)). It is a copy, so files may be refreshed while it is used"""
+        files = self.files
+        with self._lock:
+            return files.items()
+
+    def refresh(self, name):
+        """Take size and modification time of changed file again"""
+        try:
+            stat = os.stat(os.path.join(self.root, name))
+        except OSError:
+            stat = None
+        files = self.files
+        with self._lock:
+            if stat is None:
+                files.pop(name, None)
+            else:
+                files[name] = (stat.st_size, stat.st_mtime)
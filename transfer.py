@@ -0,0 +1,701 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import email.utils
+import errno
+import hashlib
+import httplib
+import json
+import logging
+import os
+import re
+import select
+import socket
+import ssl
+import threading
+import time
+import zlib
+from collections import Counter, namedtuple
+from multiprocessing.pool import ThreadPool
+from urlparse import urljoin, urlsplit, urlunsplit
+
+__author__ = "Nakoryakov Aleksey, Sysoev Roman"
+__maintainer__ = "Nakoryakov Aleksey"
+__license__ = "GPL 3.0"
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _splice = _libc.splice
+    _splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                        ctypes.c_uint]
+    _splice.restype = ctypes.c_ssize_t
+except (ImportError, OSError, AttributeError):
+    # No ctypes or no splice(2) in libc, so data is copied through python
+    _splice = None
+
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+
+
+class TransferError(Exception):
+    """Remote side didn't give us what we have asked for"""
+
+
+# Everything that can go wrong while talking to remote server
+NETWORK_ERRORS = (TransferError, httplib.HTTPException, socket.error)
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Metadata of remote file. Any field could be None if server didn't tell it
+RemoteInfo = namedtuple('RemoteInfo', 'size last_modified')
+
+
+def _native(value):
+    """httplib joins request parts as byte strings, so don't let unicode in"""
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def _ssl_kwargs():
+    """We used wget with --no-check-certificate, so keep the same behaviour where python allows"""
+    if hasattr(ssl, '_create_unverified_context'):
+        return {'context': ssl._create_unverified_context()}
+    return {}
+
+
+class Response(object):
+    """Wrapper around httplib response. Gives connection back to the pool when response is closed"""
+
+    def __init__(self, pool, key, connection, response, url):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.url = url
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def status(self):
+        return self._response.status
+
+    @property
+    def reason(self):
+        return self._response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def body_socket(self):
+        """Socket to read the rest of body from by passing httplib. It is given only when body is sent as is,
+        its length is known and nothing is buffered, otherwise None"""
+        fp = self._response.fp
+        if fp is None or self._response.chunked or not self._response.length:
+            return None
+        sock = getattr(fp, '_sock', None)
+        if sock is None or isinstance(sock, ssl.SSLSocket) or fp._rbuf.getvalue():
+            return None
+        return sock
+
+    @property
+    def length(self):
+        """Count of body bytes left to read. None if unknown"""
+        return self._response.length
+
+    def consumed(self, count):
+        """Tell that count of body bytes was read from body_socket"""
+        self._response.length -= count
+        if not self._response.length:
+            self._response.close()
+
+    def close(self):
+        """Return connection to pool if response was read to the end, otherwise drop connection"""
+        if self._connection is None:
+            return
+        if self._response._method == 'HEAD':
+            self._response.read()
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.release(self._key, self._connection)
+        else:
+            self._response.close()
+            self._connection.close()
+        self._connection = None
+
+
+class ConnectionPool(object):
+    """Keeps alive connections per host, so every request doesn't cost new TCP and TLS handshakes"""
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout=None):
+        """
+        :param timeout: socket timeout in seconds, None for system default
+        """
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        logging.debug("Opening connection to %s://%s:%s", scheme, host, port)
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self._timeout, **_ssl_kwargs())
+        return httplib.HTTPConnection(host, port, timeout=self._timeout)
+
+    def _acquire(self, key):
+        """Get idle connection for key. Second item of result tells if connection was used before"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def release(self, key, connection):
+        """Put connection back to be reused by next request to the same host"""
+        with self._lock:
+            self._idle.setdefault(key, []).append(connection)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+    def _send(self, key, method, path, headers):
+        connection, is_reused = self._acquire(key)
+        try:
+            connection.request(method, path, headers=headers)
+            return connection, connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not is_reused:
+                raise
+        # Server could drop keep-alive connection while it was idle, so give it one more chance
+        logging.debug("Reconnecting to %s://%s:%s", *key)
+        connection = self._connect(key)
+        try:
+            connection.request(method, path, headers=headers)
+            return connection, connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            raise
+
+    def request(self, method, url, headers=None):
+        """Make request following redirects.
+        :param method: HTTP method
+        :param url: url to request
+        :param headers: dict of additional headers
+        :return: Response, which must be closed after use
+        """
+        headers = dict((_native(name), _native(value)) for name, value in (headers or {}).items())
+        method = _native(method)
+        for _ in xrange(self.MAX_REDIRECTS + 1):
+            url = _native(url)
+            parts = urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            connection, raw_response = self._send(key, method, path, headers)
+            response = Response(self, key, connection, raw_response, url)
+            location = response.getheader('Location')
+            if response.status not in REDIRECT_CODES or not location:
+                return response
+            response.read()
+            response.close()
+            logging.debug("Redirected from %s to %s", url, location)
+            url = urljoin(url, location)
+            if response.status == 303:
+                method = b'GET'
+        raise TransferError("Too many redirects for {}".format(url))
+
+
+class AdaptiveChunkSize(object):
+    """Size of reads, which follows measured speed of transfer. On fast link it grows, so there are
+    less syscalls per megabyte. On slow link it shrinks, so every read is quick and progress is smooth.
+    Chosen sizes are counted in history to check the effect."""
+
+    def __init__(self, minimum, maximum, target_interval=0.05):
+        """
+        :param minimum: minimal read size in bytes
+        :param maximum: maximal read size in bytes
+        :param target_interval: how long one read should take, seconds
+        """
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.target_interval = target_interval
+        self.size = minimum
+        self.history = Counter()
+
+    def update(self, count, elapsed):
+        """Adjust size after read of count bytes which took elapsed seconds"""
+        self.history[self.size] += 1
+        if count == self.size and elapsed < self.target_interval / 2:
+            self.size = min(self.size * 2, self.maximum)
+        elif elapsed > self.target_interval * 2:
+            # Size which would be read within target interval at measured speed
+            speed = count / elapsed
+            self.size = max(self.minimum, min(self.size // 2, int(speed * self.target_interval)))
+
+    def summary(self):
+        """Human readable history of sizes, like '8KiB x 3, 16KiB x 120'"""
+        return ", ".join("{}KiB x {}".format(size // 1024, reads)
+                         for size, reads in sorted(self.history.items()))
+
+
+class RemoteInfoCache(object):
+    """Sizes and modification times of remote files. Fetched by HEAD requests running in parallel
+    and saved to index, if it is given"""
+
+    def __init__(self, pool, index=None):
+        """
+        :param pool: ConnectionPool to use
+        :param index: MetadataIndex to keep infos between runs
+        """
+        self._pool = pool
+        self._index = index
+        self._infos = {}
+
+    def get(self, url):
+        """RemoteInfo of url or None if it was not fetched"""
+        return self._infos.get(url)
+
+    def forget(self, urls):
+        """Forget infos of urls, they are fetched again when asked next time"""
+        urls = list(urls)
+        for url in urls:
+            self._infos.pop(url, None)
+        if self._index is not None:
+            self._index.forget_remote_infos(urls)
+
+    def _fetch(self, url):
+        try:
+            with self._pool.request('HEAD', url) as response:
+                if response.status != 200:
+                    raise TransferError("{} {}".format(response.status, response.reason))
+                content_length = response.getheader('Content-Length')
+                last_modified = email.utils.parsedate_tz(response.getheader('Last-Modified') or '')
+                info = RemoteInfo(int(content_length) if content_length else None,
+                                  email.utils.mktime_tz(last_modified) if last_modified else None)
+        except NETWORK_ERRORS as e:
+            logging.debug("Failed to get info of %s: %s", url, e)
+            info = RemoteInfo(None, None)
+        self._infos[url] = info
+        return url, info
+
+    def prefetch(self, urls, workers, progress=None):
+        """Fetch info of urls, which are not known yet.
+        :param urls: list of urls
+        :param workers: count of requests running at once
+        :param progress: callable to report count of fetched and count of all urls
+        """
+        urls = [url for url in urls if url not in self._infos]
+        if self._index is not None and urls:
+            for url, (size, last_modified) in self._index.remote_infos(urls).items():
+                self._infos[url] = RemoteInfo(size, last_modified)
+            urls = [url for url in urls if url not in self._infos]
+        if not urls:
+            return
+        fetched = []
+        queue = ThreadPool(min(workers, len(urls)))
+        try:
+            for done, (url, info) in enumerate(queue.imap_unordered(self._fetch, urls), 1):
+                if info.size is not None:
+                    fetched.append((url, info.size, info.last_modified))
+                if progress:
+                    progress(done, len(urls))
+        finally:
+            queue.close()
+            queue.join()
+            if self._index is not None:
+                self._index.save_remote_infos(fetched)
+
+
+class Digest(object):
+    """Digest of data computed while it streams through. Text form is '<algorithm>:<hex digest>'"""
+    ALGORITHMS = ('sha256', 'crc32')
+
+    def __init__(self, algorithm):
+        """
+        :param algorithm: one of ALGORITHMS
+        """
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError("Unknown digest algorithm {}".format(algorithm))
+        self.algorithm = algorithm
+        self._hash = hashlib.sha256() if algorithm == 'sha256' else None
+        self._crc = 0
+
+    def update(self, data):
+        if self._hash is not None:
+            self._hash.update(data)
+        else:
+            self._crc = zlib.crc32(data, self._crc)
+
+    def update_from_file(self, path, limit=None, chunk_size=1 << 16):
+        """Feed digest by data of file
+        :param limit: count of bytes from beginning of file to use. Whole file if it is None
+        """
+        with open(path, 'rb') as f:
+            while limit is None or limit > 0:
+                data = f.read(chunk_size if limit is None else min(chunk_size, limit))
+                if not data:
+                    break
+                self.update(data)
+                if limit is not None:
+                    limit -= len(data)
+
+    @property
+    def text(self):
+        value = self._hash.hexdigest() if self._hash is not None else '{:08x}'.format(self._crc & 0xffffffff)
+        return '{}:{}'.format(self.algorithm, value)
+
+
+def _splice_call(fd_in, fd_out, count, sock=None):
+    """Call splice(2) retrying on interrupts. When sock is given, waits for data within socket timeout.
+    :return: count of moved bytes
+    """
+    while True:
+        moved = _splice(fd_in, None, fd_out, None, count, SPLICE_F_MOVE | SPLICE_F_MORE)
+        if moved >= 0:
+            return moved
+        error = ctypes.get_errno()
+        if error == errno.EINTR:
+            continue
+        if error == errno.EAGAIN and sock is not None:
+            # Socket with timeout is non-blocking for the kernel
+            if not select.select([sock], [], [], sock.gettimeout())[0]:
+                raise socket.timeout("timed out")
+            continue
+        raise OSError(error, os.strerror(error))
+
+
+def splice_body(response, f_obj, progress, chunk_size=1 << 16):
+    """Move response body from socket to file by kernel, so data isn't copied through python.
+    Works only for plain (not TLS) responses of known length on systems with splice(2).
+    Does nothing if it is not possible and stops if filesystem doesn't support it,
+    so the rest of body should be read as usual.
+    :param response: response to read
+    :param f_obj: file object to write at its current position
+    :param progress: callable to report count of moved bytes
+    :param chunk_size: max size of one move, about size of pipe buffer
+    :return: count of moved bytes
+    """
+    sock = response.body_socket()
+    if _splice is None or sock is None:
+        return 0
+    f_obj.flush()
+    pipe_read, pipe_write = os.pipe()
+    moved = 0
+    try:
+        while response.length:
+            try:
+                count = _splice_call(sock.fileno(), pipe_write, min(chunk_size, response.length), sock)
+            except OSError as e:
+                if moved or e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                logging.debug("Zero-copy is not supported for sockets here: %s", e)
+                break
+            if not count:
+                break
+            response.consumed(count)
+            left = count
+            while left:
+                try:
+                    left -= _splice_call(pipe_read, f_obj.fileno(), left)
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    logging.debug("Zero-copy is not supported by filesystem: %s", e)
+                    while left:
+                        data = os.read(pipe_read, left)
+                        left -= len(data)
+                        while data:
+                            data = data[os.write(f_obj.fileno(), data):]
+                    moved += count
+                    progress(moved)
+                    return moved
+            moved += count
+            progress(moved)
+    finally:
+        os.close(pipe_read)
+        os.close(pipe_write)
+        # Data was written by file descriptor, so python file object should catch up
+        f_obj.seek(0, os.SEEK_END)
+    return moved
+
+
+def parse_content_range(value):
+    """Parse Content-Range header value like 'bytes 100-199/1000'.
+    :return: tuple (first_byte, last_byte, total_size). Unknown total size is None
+    """
+    match = re.match(r'\s*bytes\s+(\d+)-(\d+)/(\d+|\*)', value or '')
+    if not match:
+        raise TransferError("Bad Content-Range: {}".format(value))
+    first, last, total = match.groups()
+    return int(first), int(last), None if total == '*' else int(total)
+
+
+def _fsync_directory(path):
+    """Make rename durable. Not every platform and filesystem allows to sync directory, that's fine"""
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class PartialDownload(object):
+    """File which is being downloaded. Data is kept in '.part' file next to target together with
+    validators of remote file, so download could be continued by Range request after failure"""
+    PART_SUFFIX = '.part'
+    META_SUFFIX = '.part.json'
+
+    def __init__(self, path):
+        """
+        :param path: path to the target file
+        """
+        self.path = path
+        self.part_path = path + self.PART_SUFFIX
+        self.meta_path = path + self.META_SUFFIX
+
+    @property
+    def size(self):
+        """Count of bytes already downloaded"""
+        try:
+            return os.path.getsize(self.part_path)
+        except OSError:
+            return 0
+
+    def load_meta(self):
+        """Validators of remote file saved when download was started. None if there is nothing to resume"""
+        if not os.path.exists(self.part_path):
+            return None
+        try:
+            with open(self.meta_path, 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def is_resumable(self):
+        return bool(self.size and self.load_meta())
+
+    def is_segmented(self):
+        """Check if download is done by segments"""
+        meta = self.load_meta()
+        return bool(meta and meta.get('segments'))
+
+    def save_meta(self, meta):
+        with open(self.meta_path, 'wb') as f:
+            json.dump(meta, f)
+
+    def open(self, offset):
+        """Open part file for writing from offset. Everything after offset is dropped"""
+        f = open(self.part_path, 'r+b' if offset else 'wb')
+        f.seek(offset)
+        f.truncate()
+        return f
+
+    def complete(self):
+        """Replace target with downloaded data. Part file lives in the same directory as target,
+        so rename is atomic: target is either absent, old or complete, but never half written"""
+        with open(self.part_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.rename(self.part_path, self.path)
+        _fsync_directory(os.path.dirname(self.path))
+        self.discard()
+
+    def adopt(self, url, total_size, last_modified):
+        """Continue download into truncated target. Target becomes part file, and remote file is expected
+        to be the same as it is known now
+        :param total_size: size of remote file
+        :param last_modified: modification time of remote file, timestamp
+        """
+        os.rename(self.path, self.part_path)
+        self.save_meta({'url': url,
+                        'etag': None,
+                        'last_modified': email.utils.formatdate(last_modified, usegmt=True),
+                        'size': total_size})
+
+    def discard(self):
+        for path in (self.part_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def remote_meta(url, response, total_size):
+    """Validators of remote file to check later that it was not changed"""
+    return {'url': url,
+            'etag': response.getheader('ETag'),
+            'last_modified': response.getheader('Last-Modified'),
+            'size': total_size}
+
+
+def _is_same_remote_file(meta, response, total_size):
+    if meta['size'] is not None and total_size is not None and meta['size'] != total_size:
+        return False
+    for key, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')):
+        value = response.getheader(header)
+        if meta[key] and value and meta[key] != value:
+            return False
+    return True
+
+
+def _first_unfinished_segment(segments):
+    return next((segment for segment in segments if segment[0] + segment[2] <= segment[1]), None)
+
+
+def open_download(pool, url, partial):
+    """Start downloading url by single GET, continuing partial download if remote file is still the same.
+    Size of file is taken from headers of this response, so no separate HEAD request is needed.
+    For segmented partial download response is given for the first unfinished segment.
+    :param pool: ConnectionPool to use
+    :param url: url of file
+    :param partial: PartialDownload of target
+    :return: tuple (response, offset, total_size). Response body must be written from offset.
+             Total size is None if server didn't tell it. Response is None if nothing left to download
+    """
+    meta = partial.load_meta()
+    offset, last_byte = 0, ''
+    if meta and meta.get('segments'):
+        # Part file of segmented download has holes, so it can be continued only by segments
+        segment = _first_unfinished_segment(meta['segments'])
+        if segment is None:
+            return None, meta['size'], meta['size']
+        offset, last_byte = segment[0] + segment[2], segment[1]
+    elif meta:
+        offset = partial.size
+    headers = {}
+    if offset or last_byte != '':
+        headers['Range'] = 'bytes={}-{}'.format(offset, last_byte)
+        validator = meta['etag'] or meta['last_modified']
+        if validator:
+            headers['If-Range'] = validator
+    response = pool.request('GET', url, headers=headers)
+    if response.status == 206:
+        first_byte, _, total_size = parse_content_range(response.getheader('Content-Range'))
+        if first_byte == offset and _is_same_remote_file(meta, response, total_size):
+            logging.debug("Resuming %s from %d bytes", url, offset)
+            return response, offset, total_size
+        logging.debug("Remote file %s changed, starting from scratch", url)
+        response.close()
+        response = pool.request('GET', url)
+    elif response.status == 416 and offset == meta['size']:
+        response.read()
+        response.close()
+        return None, offset, offset
+    if response.status != 200:
+        response.close()
+        raise TransferError("{} {}".format(response.status, response.reason))
+    content_length = response.getheader('Content-Length')
+    total_size = int(content_length) if content_length else None
+    partial.save_meta(remote_meta(url, response, total_size))
+    return response, 0, total_size
+
+
+def accepts_ranges(response):
+    """Check if server would accept Range requests for the same url"""
+    return response.getheader('Accept-Ranges') == 'bytes'
+
+
+def _fetch_segment(pool, url, part_path, segment, validator, response=None, chunk_size=65536):
+    """Download byte range of segment [first_byte, last_byte, bytes_done] into its place in part file.
+    Segment's bytes_done is updated while downloading, so it shows progress
+    :param response: already opened response, which body starts where segment should be continued.
+                     Range is requested, if it is not given
+    """
+    first_byte, last_byte, bytes_done = segment
+    if first_byte + bytes_done > last_byte:
+        return
+    if response is None:
+        headers = {'Range': 'bytes={}-{}'.format(first_byte + bytes_done, last_byte)}
+        if validator:
+            headers['If-Range'] = validator
+        response = pool.request('GET', url, headers=headers)
+        if response.status != 206:
+            response.close()
+            raise TransferError("Range request failed: {} {}".format(response.status, response.reason))
+        if parse_content_range(response.getheader('Content-Range'))[0] != first_byte + bytes_done:
+            response.close()
+            raise TransferError("Server sent wrong range")
+    with response:
+        with open(part_path, 'r+b') as f:
+            f.seek(first_byte + bytes_done)
+            left = last_byte - first_byte - bytes_done + 1
+            while left:
+                chunk = response.read(min(chunk_size, left))
+                if not chunk:
+                    break
+                f.write(chunk)
+                segment[2] += len(chunk)
+                left -= len(chunk)
+    if segment[2] != last_byte - first_byte + 1:
+        raise TransferError("Connection lost while downloading bytes {}-{}".format(first_byte, last_byte))
+
+
+def split_segments(total_size, count):
+    """Split file to count segments [first_byte, last_byte, bytes_done]"""
+    segment_size = max(1, -(-total_size // count))
+    return [[first_byte, min(first_byte + segment_size, total_size) - 1, 0]
+            for first_byte in xrange(0, total_size, segment_size)]
+
+
+def download_segmented(pool, url, partial, response, offset, total_size, segments_count, progress,
+                       poll_interval=0.25):
+    """Download file by several parallel Range requests into one preallocated part file.
+    Response opened by open_download is used for its segment, so there is no extra request.
+    Progress of every segment is saved into part meta, so interrupted download is continued later.
+    :param pool: ConnectionPool to use
+    :param url: url of file
+    :param partial: PartialDownload of target
+    :param response: response given by open_download
+    :param offset: offset given by open_download
+    :param total_size: total_size given by open_download
+    :param segments_count: count of parallel connections for new download
+    :param progress: callable to report count of downloaded bytes
+    :param poll_interval: how often progress is reported, seconds
+    """
+    meta = partial.load_meta()
+    if meta and meta.get('segments'):
+        logging.debug("Resuming segmented download of %s", url)
+    else:
+        meta = remote_meta(url, response, total_size)
+        meta['segments'] = split_segments(total_size, segments_count)
+        with partial.open(0) as f:
+            f.truncate(total_size)
+        partial.save_meta(meta)
+    segments = meta['segments']
+    validator = meta['etag'] or meta['last_modified']
+    workers = ThreadPool(len(segments))
+    try:
+        results = []
+        for segment in segments:
+            segment_response = None
+            if response is not None and segment[0] + segment[2] == offset:
+                segment_response, response = response, None
+            results.append(workers.apply_async(_fetch_segment, (pool, url, partial.part_path, segment,
+                                                                validator, segment_response)))
+        while not all(result.ready() for result in results):
+            progress(sum(segment[2] for segment in segments))
+            time.sleep(poll_interval)
+        for result in results:
+            result.get()
+        progress(total_size)
+    finally:
+        workers.close()
+        workers.join()
+        if response is not None:
+            response.close()
+        partial.save_meta(meta)
@@ -4,20 +4,32 @@ from __future__ import unicode_literals
 
 import logging
 import os
-import shutil
-import subprocess
-import tempfile
+import time
+from datetime import date
+from fnmatch import fnmatch
+from functools import partial
 from ConfigParser import SafeConfigParser, NoSectionError, NoOptionError
 
+from multiprocessing.pool import ThreadPool
+
 from dialog import Dialog
 
-from parsers import DropboxParser
+from listing import FileInfo, Listing, ListingDiff, diff_listings
+from parsers import PARSERS, ComparingParser, DropboxParser, page_format
+from storage import (STATUS_COMPLETE, STATUS_INCOMPLETE, STATUS_PARTIAL, ListingCache, LocalFile,
+                     LocalInventory, MetadataIndex)
+from transfer import (AdaptiveChunkSize, ConnectionPool, Digest, NETWORK_ERRORS, PartialDownload,
+                      RemoteInfoCache, TransferError, accepts_ranges, download_segmented, open_download,
+                      splice_body)
 
 __author__ = "Nakoryakov Aleksey, Sysoev Roman"
 __version__ = "0.3.5"
 __maintainer__ = "Nakoryakov Aleksey"
 __license__ = "GPL 3.0"
 
+# Suffix of temporary hardlink, which replaces duplicate file
+LINK_SUFFIX = '.link'
+
 
 class Singleton(type):
     """Metaclass for singleton pattern"""
@@ -36,6 +48,25 @@ class Settings(object):
     class DEFAULTS:
         DOWNLOAD_FOLDER = os.path.expanduser('~/Download/')
         DOWNLOAD_URL = 'https://www.dropbox.com/sh/3aycxk7war34ijo/AADeK2sC0IwbNEUtPnXXaOura?dl=0'
+        TIMEOUT = 30
+        SEGMENTS = 1
+        SEGMENT_THRESHOLD = 32
+        MAX_PARALLEL_DOWNLOADS = 1
+        ZERO_COPY = True
+        MIN_CHUNK_SIZE = 8
+        MAX_CHUNK_SIZE = 512
+        GAUGE_INTERVAL = 0.2
+        METADATA_WORKERS = 4
+        PREFETCH_LISTINGS = True
+        RECURSIVE = False
+        MAX_DEPTH = 3
+        CRAWL_WORKERS = 4
+        PARSER = 'html'
+        VERIFY_PARSER = False
+        DIGEST = 'none'
+        DEDUP = False
+        QUOTA = 0
+        PARTIAL_MAX_AGE = 30
 
     def __init__(self):
         self._app_home_directory = os.path.expanduser('~/.zinc/')
@@ -54,18 +85,57 @@ class Settings(object):
             os.makedirs(self.app_home_directory)
         self._config.add_section('General')
         self._config.set('General', 'logging_debug', 'no')
+        self._config.set('General', 'timeout', str(self.DEFAULTS.TIMEOUT))
+        self._config.set('General', 'segments', str(self.DEFAULTS.SEGMENTS))
+        self._config.set('General', 'segment_threshold', str(self.DEFAULTS.SEGMENT_THRESHOLD))
+        self._config.set('General', 'max_parallel_downloads', str(self.DEFAULTS.MAX_PARALLEL_DOWNLOADS))
+        self._config.set('General', 'zero_copy', 'yes' if self.DEFAULTS.ZERO_COPY else 'no')
+        self._config.set('General', 'min_chunk_size', str(self.DEFAULTS.MIN_CHUNK_SIZE))
+        self._config.set('General', 'max_chunk_size', str(self.DEFAULTS.MAX_CHUNK_SIZE))
+        self._config.set('General', 'gauge_interval', str(self.DEFAULTS.GAUGE_INTERVAL))
+        self._config.set('General', 'metadata_workers', str(self.DEFAULTS.METADATA_WORKERS))
+        self._config.set('General', 'prefetch_listings', 'yes' if self.DEFAULTS.PREFETCH_LISTINGS else 'no')
+        self._config.set('General', 'recursive', 'yes' if self.DEFAULTS.RECURSIVE else 'no')
+        self._config.set('General', 'max_depth', str(self.DEFAULTS.MAX_DEPTH))
+        self._config.set('General', 'crawl_workers', str(self.DEFAULTS.CRAWL_WORKERS))
+        self._config.set('General', 'parser', self.DEFAULTS.PARSER)
+        self._config.set('General', 'verify_parser', 'yes' if self.DEFAULTS.VERIFY_PARSER else 'no')
+        self._config.set('General', 'digest', self.DEFAULTS.DIGEST)
+        self._config.set('General', 'dedup', 'yes' if self.DEFAULTS.DEDUP else 'no')
+        self._config.set('General', 'quota', str(self.DEFAULTS.QUOTA))
+        self._config.set('General', 'pinned', '')
+        self._config.set('General', 'partial_max_age', str(self.DEFAULTS.PARTIAL_MAX_AGE))
         self._config.add_section('Dropbox')
         self._config.set('Dropbox', 'default', self.DEFAULTS.DOWNLOAD_URL)
+        self._config.add_section('Providers')
+        self._config.set('Providers', 'autoindex', '')
         self._config.add_section('Folders')
         self._config.set('Folders', 'download_folder', self.DEFAULTS.DOWNLOAD_FOLDER)
         settings_filepath = os.path.join(self.app_home_directory, self._settings_filename)
         with open(settings_filepath, 'wb') as configfile:
             self._config.write(configfile)
 
+    def _get_option(self, method, section, option, default):
+        """Get option by config method (get, getint, getboolean...). Default is returned if it is not set"""
+        try:
+            return getattr(self._config, method)(section, option)
+        except (NoSectionError, NoOptionError):
+            return default
+
+    def _get_repo_option(self, repo, method, option, default):
+        """Get option from repo's own section [repo:<name>]. Falls back to the same option of [General]"""
+        general_value = self._get_option(method, 'General', option, default)
+        return self._get_option(method, 'repo:' + repo, option, general_value)
+
     @property
     def app_home_directory(self):
         return self._app_home_directory
 
+    @property
+    def index_path(self):
+        """Path to database of metadata index"""
+        return os.path.join(self.app_home_directory, 'zinc.db')
+
     @property
     def download_path(self):
         path = self._config.get('Folders', 'download_folder')
@@ -79,75 +149,480 @@ class Settings(object):
 
     @property
     def do_logging(self):
-        try:
-            return self._config.getboolean('General', 'logging_debug')
-        except (NoSectionError, NoOptionError):
-            return False
+        return self._get_option('getboolean', 'General', 'logging_debug', False)
+
+    @property
+    def timeout(self):
+        """Network timeout in seconds"""
+        return self._get_option('getfloat', 'General', 'timeout', self.DEFAULTS.TIMEOUT)
+
+    @property
+    def max_parallel_downloads(self):
+        """Count of files downloaded at once"""
+        return max(1, self._get_option('getint', 'General', 'max_parallel_downloads',
+                                       self.DEFAULTS.MAX_PARALLEL_DOWNLOADS))
+
+    @property
+    def zero_copy(self):
+        """Let kernel move downloaded data from socket to file, when it is possible"""
+        return self._get_option('getboolean', 'General', 'zero_copy', self.DEFAULTS.ZERO_COPY)
+
+    @property
+    def min_chunk_size(self):
+        """Minimal size of reads while downloading. Option is in KiB, result in bytes"""
+        kilobytes = self._get_option('getint', 'General', 'min_chunk_size', self.DEFAULTS.MIN_CHUNK_SIZE)
+        return max(1, kilobytes) * 1024
+
+    @property
+    def max_chunk_size(self):
+        """Maximal size of reads while downloading. Option is in KiB, result in bytes"""
+        return self._get_option('getint', 'General', 'max_chunk_size', self.DEFAULTS.MAX_CHUNK_SIZE) * 1024
+
+    @property
+    def gauge_interval(self):
+        """Minimal interval between updates of progress gauge, seconds"""
+        return self._get_option('getfloat', 'General', 'gauge_interval', self.DEFAULTS.GAUGE_INTERVAL)
+
+    @property
+    def partial_max_age(self):
+        """Part files of interrupted downloads not continued for this count of days are removed"""
+        return self._get_option('getfloat', 'General', 'partial_max_age', self.DEFAULTS.PARTIAL_MAX_AGE)
+
+    @property
+    def metadata_workers(self):
+        """Count of requests for sizes of files running at once. Zero turns sizes off"""
+        return self._get_option('getint', 'General', 'metadata_workers', self.DEFAULTS.METADATA_WORKERS)
+
+    @property
+    def prefetch_listings(self):
+        """Fetch filelists of all repos in background at start"""
+        return self._get_option('getboolean', 'General', 'prefetch_listings', self.DEFAULTS.PREFETCH_LISTINGS)
+
+    def segments(self, repo):
+        """Count of parallel connections to download one large file of repo"""
+        return max(1, self._get_repo_option(repo, 'getint', 'segments', self.DEFAULTS.SEGMENTS))
+
+    def segment_threshold(self, repo):
+        """Files of repo smaller than this are downloaded by single connection. In bytes"""
+        megabytes = self._get_repo_option(repo, 'getfloat', 'segment_threshold',
+                                          self.DEFAULTS.SEGMENT_THRESHOLD)
+        return int(megabytes * 1024 * 1024)
+
+    def max_depth(self, repo):
+        """How deep subfolders of repo are crawled. Zero means only files of shared folder itself"""
+        if not self._get_repo_option(repo, 'getboolean', 'recursive', self.DEFAULTS.RECURSIVE):
+            return 0
+        return max(0, self._get_repo_option(repo, 'getint', 'max_depth', self.DEFAULTS.MAX_DEPTH))
+
+    def crawl_workers(self, repo):
+        """Count of subfolder pages of repo requested at once"""
+        return max(1, self._get_repo_option(repo, 'getint', 'crawl_workers', self.DEFAULTS.CRAWL_WORKERS))
+
+    def digest(self, repo):
+        """Algorithm of digests of files downloaded from repo, one of Digest.ALGORITHMS.
+        None if digests are not computed"""
+        algorithm = self._get_repo_option(repo, 'get', 'digest', self.DEFAULTS.DIGEST)
+        if algorithm in ('', 'none'):
+            return None
+        if algorithm not in Digest.ALGORITHMS:
+            logging.error("Unknown digest %s of repo %s, digests are not computed", algorithm, repo)
+            return None
+        return algorithm
+
+    def dedup(self, repo):
+        """Make files of repo hardlinks to local files of the same content instead of keeping copies"""
+        return self._get_repo_option(repo, 'getboolean', 'dedup', self.DEFAULTS.DEDUP)
+
+    def quota(self, repo=None):
+        """Limit of size of files downloaded from repo in bytes. Limit of whole download folder,
+        if repo is None. Zero means no limit"""
+        section = 'General' if repo is None else 'repo:' + repo
+        return int(self._get_option('getfloat', section, 'quota', self.DEFAULTS.QUOTA) * 1024 * 1024)
+
+    def pinned(self, repo=None):
+        """Shell-style patterns of names of files, which are never removed to free space"""
+        if repo is None:
+            patterns = self._get_option('get', 'General', 'pinned', '')
+        else:
+            patterns = self._get_repo_option(repo, 'get', 'pinned', '')
+        return patterns.replace(',', ' ').split()
+
+    def provider(self, url):
+        """Name of parser for pages of url chosen by url patterns of [Providers] section.
+        Each option there is name of parser and list of shell-style patterns separated by spaces or commas.
+        None is returned if no pattern matches"""
+        if not self._config.has_section('Providers'):
+            return None
+        for name, patterns in self._config.items('Providers'):
+            if any(fnmatch(url, pattern) for pattern in patterns.replace(',', ' ').split()):
+                return name
+        return None
+
+    def parser(self, repo, url):
+        """Factory of parser for pages of repo. Parser set in repo's own section is used first,
+        then one of provider matching url of repo, then one set in [General].
+        Result of other parser of Dropbox pages is checked against DropboxParser if verify_parser is set"""
+        name = (self._get_option('get', 'repo:' + repo, 'parser', None) or self.provider(url) or
+                self._get_option('get', 'General', 'parser', self.DEFAULTS.PARSER))
+        if name not in PARSERS:
+            logging.error("Unknown parser %s of repo %s, %s is used", name, repo, self.DEFAULTS.PARSER)
+            name = self.DEFAULTS.PARSER
+        parser_class = PARSERS[name]
+        if (issubclass(parser_class, DropboxParser) and parser_class is not DropboxParser and
+                self._get_repo_option(repo, 'getboolean', 'verify_parser', self.DEFAULTS.VERIFY_PARSER)):
+            return partial(ComparingParser, parser_class)
+        return parser_class
 
 
-def chunk_read_write(process, total_size, f_obj, dialog, chunk_size=8192):
-    """Read process stdout by chunks and write that chunks to file-like object
-    :param process: process which stdout to read
-    :param total_size: expected total size just for progress reporting
+def chunk_read_write(response, total_size, f_obj, dialog, chunk_size=8192, bytes_so_far=0, zero_copy=False,
+                     max_chunk_size=None, digest=None):
+    """Read response by chunks and write that chunks to file-like object
+    :param response: response to read
+    :param total_size: expected total size just for progress reporting. None if it is unknown,
+                       then count of received bytes is shown instead of percents
     :param f_obj: file-like object to write
     :param dialog: dialog to report about progress
-    :param chunk_size: size of chunks to read-write
+    :param chunk_size: size of chunks to read-write. Minimal size, if max_chunk_size is given
+    :param bytes_so_far: count of bytes written before, when download is resumed
+    :param zero_copy: let kernel move data from socket to file where it is possible
+    :param max_chunk_size: chunks grow up to this size while transfer is fast enough
+    :param digest: Digest to feed by written data. Data must pass through python then, so zero_copy is off
+    :return: count of bytes written including bytes_so_far
     """
-    bytes_so_far = 0
+    def report(count):
+        if total_size:
+            dialog.gauge_update(int(count * 100.0 / total_size))
+        else:
+            dialog.gauge_update(0, "Received {}".format(sizeof_fmt(count)), update_text=True)
+
+    if zero_copy and digest is None:
+        offset = bytes_so_far
+        bytes_so_far += splice_body(response, f_obj, lambda moved: report(offset + moved))
+    chunk_sizes = AdaptiveChunkSize(chunk_size, max_chunk_size or chunk_size)
     while True:
-        chunk = process.stdout.read(chunk_size)
+        started = time.time()
+        chunk = response.read(chunk_sizes.size)
         if not chunk:
             break
         bytes_so_far += len(chunk)
         f_obj.write(chunk)
-        percent = int(bytes_so_far * 100.0 / total_size)
-        dialog.gauge_update(percent)
-    process.wait()
+        if digest is not None:
+            digest.update(chunk)
+        chunk_sizes.update(len(chunk), time.time() - started)
+        report(bytes_so_far)
+    logging.debug("Chunk sizes used: %s", chunk_sizes.summary())
+    return bytes_so_far
 
 
-def download_file(url, directory_to, filename, dialog):
-    """Download single file from url"""
+def download_file(url, directory_to, filename, dialog, segments=1, segment_threshold=0, zero_copy=False,
+                  chunk_size=8192, max_chunk_size=None, digest=None, dedup=False):
+    """Download single file from url by one request. Download interrupted before is continued where possible
+    :param segments: count of parallel connections to download large file
+    :param segment_threshold: files smaller than this size in bytes are downloaded by one connection
+    :param zero_copy: let kernel move data from socket to file where it is possible
+    :param chunk_size: minimal size of reads
+    :param max_chunk_size: size of reads grows up to this while transfer is fast enough
+    :param digest: algorithm of digest computed while file is downloaded. Data downloaded before or by
+                   segments is read from disk for it
+    :param dedup: make downloaded file hardlink to local file of the same size and digest. Needs digest
+    :return: LocalFile of downloaded file
+    """
     path = os.path.join(directory_to, filename)
-    filesize = get_filesize(url)
-    process = subprocess.Popen('wget --no-check-certificate -qO- ' + url,
-                               stdout=subprocess.PIPE,
-                               bufsize=0,
-                               shell=True)
-    dialog.gauge_start("Downloading {} of {}".format(sizeof_fmt(filesize), filename))
-    with tempfile.NamedTemporaryFile() as f:
-        chunk_read_write(process, filesize, f, dialog=dialog)
-        f.seek(0)
-        shutil.copy(f.name, path)
-    dialog.gauge_stop()
-
-
-def is_file_exists(filename):
-    """Check if file exists in download directory"""
-    download_directory = Settings().download_path
-    local_filename = os.path.join(download_directory, filename)
-    return os.path.exists(local_filename) and os.path.getsize(local_filename)
-
-
-def choose_files(file_urls, dialog):
-    """Choose files to download via dialog"""
-    items = [(url, filename, False) for filename, url in file_urls]
-    result = dialog.buildlist("Choose files to download",
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        # File of subfolder keeps its relative path
+        os.makedirs(directory)
+    partial = PartialDownload(path)
+    if is_truncated(path, remote_info.get(url)) and partial.load_meta() is None:
+        logging.debug("Continuing truncated %s", path)
+        info = remote_info.get(url)
+        partial.adopt(url, info.size, info.last_modified)
+    # Download killed on the way stays known as partial, so its part file can be cleaned later
+    record_local_file(path, STATUS_PARTIAL)
+    response, offset, total_size = open_download(pool, url, partial)
+    file_digest = Digest(digest) if digest else None
+    if response is None:
+        if file_digest is not None:
+            file_digest.update_from_file(partial.part_path)
+        partial.complete()
+        return finish_download(path, file_digest, dedup)
+    with response:
+        if total_size is None:
+            size_text = filename
+        else:
+            size_text = "{} of {}".format(sizeof_fmt(total_size), filename)
+        is_large = total_size is not None and total_size >= max(segment_threshold, segments)
+        if partial.is_segmented() or (not offset and segments > 1 and is_large and accepts_ranges(response)):
+            def report(bytes_so_far):
+                dialog.gauge_update(int(bytes_so_far * 100.0 / total_size))
+
+            dialog.gauge_start("Downloading {} by {} connections".format(size_text, segments))
+            try:
+                download_segmented(pool, url, partial, response, offset, total_size, segments, report)
+            finally:
+                dialog.gauge_stop()
+            if file_digest is not None:
+                # Segments come out of order
+                file_digest.update_from_file(partial.part_path)
+        else:
+            action = "Resuming" if offset else "Downloading"
+            dialog.gauge_start("{} {}".format(action, size_text),
+                               percent=offset * 100 // total_size if total_size else 0)
+            try:
+                if file_digest is not None and offset:
+                    file_digest.update_from_file(partial.part_path, offset)
+                with partial.open(offset) as f:
+                    bytes_so_far = chunk_read_write(response, total_size, f, dialog=dialog,
+                                                    chunk_size=chunk_size, bytes_so_far=offset,
+                                                    zero_copy=zero_copy, max_chunk_size=max_chunk_size,
+                                                    digest=file_digest)
+            finally:
+                dialog.gauge_stop()
+            if total_size is not None and bytes_so_far != total_size:
+                raise TransferError("Connection lost after {} of {}".format(sizeof_fmt(bytes_so_far),
+                                                                           sizeof_fmt(total_size)))
+    partial.complete()
+    return finish_download(path, file_digest, dedup)
+
+
+def finish_download(path, digest, dedup):
+    """Record downloaded file. With dedup it is replaced by hardlink to local file of the same content
+    :param digest: Digest of file or None
+    """
+    digest_text = digest.text if digest is not None else None
+    if dedup and digest is not None:
+        link_same_content(path, digest)
+    return record_local_file(path, digest=digest_text)
+
+
+def same_size_files(size, path):
+    """Content index: local files of given size other than path. Digests are taken from index
+    :return: list of LocalFile
+    """
+    paths = {}
+    for name, (file_size, mtime) in inventory.items():
+        if file_size == size and not _is_service_file(name):
+            paths[os.path.join(inventory.root, name)] = mtime
+    paths.pop(path, None)
+    known = index.local_files(paths)
+    return [known[file_path] if file_path in known and known[file_path].mtime == mtime
+            else LocalFile(file_path, size, mtime, None, STATUS_COMPLETE)
+            for file_path, mtime in paths.items()]
+
+
+def content_digest(local_file, algorithm):
+    """Digest text of local file computed by algorithm. Digest computed here is saved to index"""
+    if local_file.digest and local_file.digest.startswith(algorithm + ':'):
+        return local_file.digest
+    digest = Digest(algorithm)
+    digest.update_from_file(local_file.path)
+    index.save_local_files([local_file._replace(digest=digest.text)])
+    return digest.text
+
+
+def _link(source, path):
+    """Make path hardlink to source, replacing path atomically if it exists. False if it is not possible"""
+    temporary_path = path + LINK_SUFFIX
+    try:
+        os.link(source, temporary_path)
+        os.rename(temporary_path, path)
+    except OSError as e:
+        # Filesystem without hardlinks, like FAT of SD card, or files on different filesystems
+        logging.debug("Failed to link %s to %s: %s", path, source, e)
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        return False
+    logging.debug("%s is linked to %s", path, source)
+    return True
+
+
+def link_same_content(path, digest):
+    """Replace downloaded file by hardlink to local file of the same size and digest
+    :param digest: Digest of downloaded file
+    :return: True if file is replaced
+    """
+    for candidate in same_size_files(os.path.getsize(path), path):
+        if os.path.samefile(candidate.path, path):
+            continue
+        if content_digest(candidate, digest.algorithm) == digest.text and _link(candidate.path, path):
+            return True
+    return False
+
+
+def record_local_file(path, status=STATUS_COMPLETE, digest=None):
+    """Save state of downloaded file to index and inventory
+    :param digest: text of digest of complete file
+    :return: saved LocalFile
+    """
+    if status == STATUS_COMPLETE:
+        local_file = LocalFile(path, os.path.getsize(path), os.path.getmtime(path), digest, status)
+    else:
+        local_file = LocalFile(path, PartialDownload(path).size, None, None, status)
+    index.save_local_files([local_file])
+    name = os.path.relpath(path, inventory.root)
+    inventory.refresh(name)
+    inventory.refresh(name + PartialDownload.PART_SUFFIX)
+    inventory.refresh(name + PartialDownload.META_SUFFIX)
+    return local_file
+
+
+def record_download(repo, filename, local_file):
+    """Remember that file is downloaded from repo and used now. Its digest is added to manifest of repo"""
+    if local_file.digest:
+        index.save_manifest(repo, [(filename, local_file.size, local_file.digest)])
+    index.save_usage([(local_file.path, repo, time.time())])
+
+
+def is_truncated(path, info):
+    """Check if local file is shorter than remote one and was written after remote file was modified,
+    so it is beginning of the same file and download could be continued from its size
+    :param info: RemoteInfo of remote file
+    """
+    if info is None or info.size is None or info.last_modified is None or not os.path.exists(path):
+        return False
+    return os.path.getsize(path) < info.size and os.path.getmtime(path) >= info.last_modified
+
+
+def local_states(filenames):
+    """State of files in download directory. Index knows status of files downloaded by zinc,
+    inventory knows which files are there now. Files unknown to index or changed are saved to it
+    in one transaction, files which are gone are forgotten by it.
+    :return: dict filename -> LocalFile or None if there is no such file
+    """
+    paths = dict((os.path.join(inventory.root, filename), filename) for filename in filenames)
+    known = index.local_files(paths)
+    states = {}
+    found = []
+    gone = []
+    for path, filename in paths.items():
+        local_file = known.get(path)
+        on_disk = inventory.get(filename)
+        if on_disk is None and local_file is not None and local_file.status != STATUS_PARTIAL:
+            gone.append(path)
+            local_file = None
+        elif on_disk is not None and (local_file is None or local_file.status == STATUS_PARTIAL or
+                                      (local_file.size, local_file.mtime) != on_disk):
+            local_file = LocalFile(path, on_disk[0], on_disk[1], None, STATUS_COMPLETE)
+            found.append(local_file)
+        states[filename] = local_file
+    index.save_local_files(found)
+    index.forget_local_files(gone)
+    return states
+
+
+def verify_sizes(states, url_list):
+    """Compare sizes of local files with sizes of remote ones, where they are known.
+    Complete files of other size are marked incomplete, incomplete files of the same size complete again.
+    Changed states are saved to index in one transaction
+    :param states: dict filename -> LocalFile like local_states gives. It is updated
+    """
+    changed = []
+    for filename, url in url_list:
+        local_file = states[filename]
+        info = remote_info.get(url)
+        if local_file is None or local_file.status == STATUS_PARTIAL or info is None or info.size is None:
+            continue
+        status = STATUS_COMPLETE if local_file.size == info.size else STATUS_INCOMPLETE
+        if status != local_file.status:
+            logging.debug("%s is %s, %d of %d bytes", filename, status, local_file.size, info.size)
+            local_file = states[filename] = local_file._replace(status=status)
+            changed.append(local_file)
+    index.save_local_files(changed)
+
+
+def is_downloaded(local_file):
+    """Check if LocalFile is complete non-empty file"""
+    return local_file is not None and local_file.status == STATUS_COMPLETE and local_file.size > 0
+
+
+def is_file_resumable(filename):
+    """Check if file was partially downloaded and download could be continued"""
+    if filename + PartialDownload.PART_SUFFIX not in inventory:
+        return False
+    return PartialDownload(os.path.join(inventory.root, filename)).is_resumable()
+
+
+def file_label(filename, url, mark=None, local_file=None):
+    """Text to show file in lists
+    :param mark: what happened to file in repo since last visit, like "new"
+    :param local_file: LocalFile of file if it is in download directory
+    """
+    details = [mark] if mark else []
+    if local_file is not None and local_file.status == STATUS_INCOMPLETE:
+        details.append("incomplete, {} here".format(sizeof_fmt(local_file.size)))
+    info = remote_info.get(url)
+    if info and info.size is not None:
+        details.append(sizeof_fmt(info.size))
+    if info and info.last_modified is not None:
+        details.append(date.fromtimestamp(info.last_modified).isoformat())
+    if is_file_resumable(filename):
+        details.append("partial, resumable")
+    return "{} ({})".format(filename, ", ".join(details)) if details else filename
+
+
+def choose_files(file_urls, dialog, diff=None, states=None):
+    """Choose files to download via dialog. Files new in repo are selected already
+    :param diff: ListingDiff of repo since last visit
+    :param states: dict filename -> LocalFile like local_states gives
+    """
+    states = states or {}
+    diff = diff or ListingDiff(set(), set(), set())
+    items = []
+    for filename, url in file_urls:
+        mark = "new" if filename in diff.added else "changed" if filename in diff.changed else None
+        items.append((url, file_label(filename, url, mark, states.get(filename)), filename in diff.added))
+    title = "Choose files to download"
+    if any(diff):
+        title += " ({} new, {} changed, {} removed since last visit)".format(
+            len(diff.added), len(diff.changed), len(diff.removed))
+    result = dialog.buildlist(title,
                               items=items,
                               visit_items=True, help_status=False)
     return result[1] if result[0] == dialog.DIALOG_OK else []
 
 
-def get_filesize(url):
-    """Get size of file at url by simple HEAD request"""
-    process = subprocess.Popen('wget --no-check-certificate --spider -q -S -O - ' + url,
-                               stderr=subprocess.PIPE,
-                               bufsize=0,
-                               shell=True)
-    content_length_line = next((line for line in process.stderr.readlines()
-                                if 'Content-Length:' in line))
-    res = int(content_length_line.replace('Content-Length:', '').strip())
-    process.wait()
-    return res
+def prefetch_remote_info(dialog, urls):
+    """Fetch sizes of files to show them in lists"""
+    workers = settings.metadata_workers
+    if workers < 1:
+        return
+    gauge = GaugeReporter(dialog, min_interval=settings.gauge_interval)
+    gauge.gauge_start("Requesting file sizes...")
+    try:
+        remote_info.prefetch(urls, workers, lambda done, count: gauge.gauge_update(done * 100 // count))
+    finally:
+        gauge.gauge_stop()
+
+
+def refresh_snapshot(dialog, repo, url_list):
+    """Compare filelist of repo with one seen last time and remember it instead.
+    Sizes of files are fetched first, unless they are known already
+    :return: ListingDiff. It is empty if repo is seen first time
+    """
+    previous = index.load_snapshot(repo)
+    known = previous or {}
+    prefetch_remote_info(dialog, [url for _, url in url_list])
+    current = {}
+    for filename, url in url_list:
+        info = remote_info.get(url)
+        current[filename] = info.size if info else None
+    diff = ListingDiff(set(), set(), set()) if previous is None else diff_listings(previous, current)
+    logging.debug("Repo %s: %d new, %d changed, %d removed files", repo, len(diff.added), len(diff.changed),
+                  len(diff.removed))
+    # Size, which is unknown now, is remembered from last time
+    current.update((filename, known.get(filename)) for filename, size in current.items() if size is None)
+    index.save_snapshot(repo, current)
+    return diff
+
+
+def confirm_download(dialog, urls):
+    """Ask if user really wants to download selected files showing their total size"""
+    infos = [remote_info.get(url) for url in urls]
+    sizes = [info.size for info in infos if info and info.size is not None]
+    text = "Download {} files, {} total?".format(len(urls), sizeof_fmt(sum(sizes)))
+    if len(sizes) != len(urls):
+        text += "\nSize of {} files is unknown".format(len(urls) - len(sizes))
+    return dialog.yesno(text) == dialog.DIALOG_OK
 
 
 def sizeof_fmt(num, suffix='B'):
@@ -158,73 +633,577 @@ def sizeof_fmt(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
-def process_filelist(dialog, url_list):
+class GaugeReporter(object):
+    """Gauge of dialog, which doesn't bother dialog for nothing. Every update is a write to dialog's pipe
+    and a redraw, so update is sent only when percent or text changes and not more often than min_interval,
+    except the final one. Skipped updates are counted."""
+
+    def __init__(self, dialog, min_interval=0.2):
+        """
+        :param dialog: dialog object to show gauge
+        :param min_interval: minimal interval between updates, seconds
+        """
+        self._dialog = dialog
+        self._min_interval = min_interval
+        self._percent = None
+        self._text = None
+        self._sent_at = 0
+        self.sent = 0
+        self.skipped = 0
+
+    def gauge_start(self, text="", percent=0, **kwargs):
+        self._percent = percent
+        self._text = text
+        self._sent_at = time.time()
+        self.sent = 0
+        self.skipped = 0
+        self._dialog.gauge_start(text, percent=percent, **kwargs)
+
+    def gauge_update(self, percent, text="", update_text=False):
+        now = time.time()
+        is_changed = percent != self._percent or (update_text and text != self._text)
+        is_due = now - self._sent_at >= self._min_interval or percent >= 100
+        if is_changed and is_due:
+            self._dialog.gauge_update(percent, text, update_text)
+            self._percent = percent
+            if update_text:
+                self._text = text
+            self._sent_at = now
+            self.sent += 1
+        else:
+            self.skipped += 1
+
+    def gauge_stop(self):
+        logging.debug("Gauge updates sent: %d, skipped: %d", self.sent, self.skipped)
+        return self._dialog.gauge_stop()
+
+
+class DownloadStatus(object):
+    """Status of download running in background. Pretends to be a gauge for download_file"""
+    PENDING, RUNNING, SUCCEEDED, FAILED = range(4)
+
+    def __init__(self, url, filename):
+        self.url = url
+        self.filename = filename
+        self.state = self.PENDING
+        self.percent = 0
+        self.text = None
+        self.error = None
+
+    def gauge_start(self, text="", percent=0, **kwargs):
+        self.state = self.RUNNING
+        self.percent = percent
+
+    def gauge_update(self, percent, text="", update_text=False):
+        self.percent = percent
+        if update_text:
+            self.text = text
+
+    def gauge_stop(self):
+        pass
+
+    @property
+    def is_finished(self):
+        return self.state in (self.SUCCEEDED, self.FAILED)
+
+    @property
+    def item(self):
+        """Item of mixedgauge element: negative number is progress bar, 0 is Succeeded, 1 is Failed"""
+        if self.state == self.RUNNING:
+            # Text is shown when size is unknown and there is no percent to show
+            if self.text:
+                return self.text
+            # -0 would be shown as Succeeded
+            return -self.percent if self.percent else "In Progress"
+        return {self.PENDING: "Pending", self.SUCCEEDED: 0, self.FAILED: 1}[self.state]
+
+
+def _is_service_file(name):
+    return name.endswith((PartialDownload.PART_SUFFIX, PartialDownload.META_SUFFIX, LINK_SUFFIX))
+
+
+def remove_local_files(paths):
+    """Remove files from download directory, index and inventory"""
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.error("Failed to remove %s: %s", path, e)
+        inventory.refresh(os.path.relpath(path, inventory.root))
+    index.forget_local_files(paths)
+
+
+def clean_partials(max_age):
+    """Remove orphaned files of interrupted downloads: part files without validators, so they can't be
+    continued, validators without part files, and part files not continued for max_age days.
+    Only downloads which index knows as partial are touched, part files of other programs stay
+    :return: count of removed bytes
+    """
+    oldest = time.time() - max_age * 24 * 60 * 60
+    files = dict(inventory.items())
+    orphaned = {}
+    for name, (size, mtime) in files.items():
+        if name.endswith(PartialDownload.META_SUFFIX):
+            target = name[:-len(PartialDownload.META_SUFFIX)]
+            is_orphaned = target + PartialDownload.PART_SUFFIX not in files
+        elif name.endswith(PartialDownload.PART_SUFFIX):
+            target = name[:-len(PartialDownload.PART_SUFFIX)]
+            # Validators are looked for on disk too, so download can't lose them by stale inventory
+            has_meta = (target + PartialDownload.META_SUFFIX in files or
+                        os.path.exists(os.path.join(inventory.root, target + PartialDownload.META_SUFFIX)))
+            is_orphaned = not has_meta or mtime < oldest
+        else:
+            continue
+        if is_orphaned:
+            orphaned[os.path.join(inventory.root, target)] = target
+    partial = [path for path, local_file in index.local_files(orphaned).items()
+               if local_file.status == STATUS_PARTIAL]
+    removed = []
+    removed_size = 0
+    for path in partial:
+        for suffix in (PartialDownload.PART_SUFFIX, PartialDownload.META_SUFFIX):
+            name = orphaned[path] + suffix
+            if name in files or os.path.exists(path + suffix):
+                logging.debug("Removing orphaned %s", name)
+                removed.append(path + suffix)
+                removed_size += files.get(name, (0, None))[0]
+    remove_local_files(removed)
+    # Index shouldn't keep them as partial downloads any more
+    index.forget_local_files(partial)
+    return removed_size
+
+
+def eviction_candidates(keep):
+    """Files downloaded by zinc, which may be removed to free space, least recently used first.
+    Files without recorded use weren't downloaded by zinc and are never proposed.
+    Time of use is the latest of access time, if filesystem keeps it, and time zinc downloaded file
+    :param keep: paths which must stay
+    :return: list of tuples (last_used, path, size, repo, inode, links). Inode is (st_dev, st_ino),
+             links is count of hardlinks, file with other hardlinks frees no space when it is removed
+    """
+    usage = index.usage()
+    candidates = []
+    for name, (size, _) in inventory.items():
+        path = os.path.join(inventory.root, name)
+        if _is_service_file(name) or path in keep:
+            continue
+        if path not in usage:
+            continue
+        repo, recorded = usage[path]
+        if any(fnmatch(name, pattern) for pattern in settings.pinned(repo)):
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        candidates.append((max(stat.st_atime, recorded), path, size, repo, (stat.st_dev, stat.st_ino),
+                           stat.st_nlink))
+    candidates.sort()
+    return candidates
+
+
+def _inodes():
+    """Files of download directory by inodes, so hardlinks of one file are counted once
+    :return: dict (st_dev, st_ino) -> tuple (size, list of paths)
+    """
+    inodes = {}
+    for name, (size, _) in inventory.items():
+        path = os.path.join(inventory.root, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        inodes.setdefault((stat.st_dev, stat.st_ino), (size, []))[1].append(path)
+    return inodes
+
+
+def plan_eviction(jobs, repo):
+    """Choose files to remove before jobs are downloaded, so quota of repo and quota of download directory
+    are kept and files fit to disk
+    :param jobs: list of tuples (url, filename)
+    :return: tuple (list of paths to remove, count of bytes which can't be freed)
+    """
+    keep = set()
+    needed = 0
+    for url, filename in jobs:
+        path = os.path.join(inventory.root, filename)
+        keep.add(path)
+        info = remote_info.get(url)
+        if info is not None and info.size is not None:
+            part = inventory.get(filename + PartialDownload.PART_SUFFIX)
+            needed += max(0, info.size - (part[0] if part else 0))
+    candidates = eviction_candidates(keep)
+    disk = os.statvfs(inventory.root)
+    # Each limit is (count of bytes over it, check if candidate frees space for it)
+    limits = []
+    repo_quota = settings.quota(repo)
+    total_quota = settings.quota()
+    if repo_quota or total_quota:
+        inodes = _inodes()
+        # Candidate frees space in download directory only if it has no other hardlinks there
+        is_single = lambda candidate: len(inodes.get(candidate[4], (0, []))[1]) <= 1
+    if repo_quota:
+        usage = index.usage()
+        used = sum(size for size, paths in inodes.values()
+                   if any(usage.get(path, (None,))[0] == repo for path in paths))
+        limits.append((used + needed - repo_quota,
+                       lambda candidate: candidate[3] == repo and is_single(candidate)))
+    if total_quota:
+        used = sum(size for size, _ in inodes.values())
+        limits.append((used + needed - total_quota, is_single))
+    limits.append((needed - disk.f_bavail * disk.f_frsize, lambda candidate: candidate[5] == 1))
+    evicted = []
+    shortage = 0
+    for excess, is_freeing in limits:
+        excess -= sum(candidate[2] for candidate in evicted if is_freeing(candidate))
+        for candidate in candidates:
+            if excess <= 0:
+                break
+            if candidate not in evicted and is_freeing(candidate):
+                evicted.append(candidate)
+                excess -= candidate[2]
+        shortage = max(shortage, excess)
+    return [candidate[1] for candidate in evicted], shortage
+
+
+def make_room(dialog, jobs, repo):
+    """Clean orphaned part files and remove least recently used files, if it is needed to keep quotas
+    and to fit files of jobs to disk. User is asked before files are removed
+    :param jobs: list of tuples (url, filename)
+    :return: False if user decided not to download
+    """
+    cleaned = clean_partials(settings.partial_max_age)
+    if cleaned:
+        logging.debug("Orphaned part files of %s are removed", sizeof_fmt(cleaned))
+    evicted, shortage = plan_eviction(jobs, repo)
+    if evicted:
+        size = sum(inventory.get(os.path.relpath(path, inventory.root))[0] for path in evicted)
+        names = [os.path.relpath(path, inventory.root) for path in evicted]
+        text = "To free space {} least recently used files ({}) will be removed:\n{}".format(
+            len(evicted), sizeof_fmt(size), "\n".join(names))
+        if dialog.yesno(text) != dialog.DIALOG_OK:
+            return False
+        remove_local_files(evicted)
+    if shortage > 0:
+        text = "{} more space is needed for these files. Download anyway?".format(sizeof_fmt(shortage))
+        return dialog.yesno(text) == dialog.DIALOG_OK
+    return True
+
+
+def download_options(repo):
+    """Keyword arguments of download_file, which depend on repo settings"""
+    return {'segments': settings.segments(repo),
+            'segment_threshold': settings.segment_threshold(repo),
+            'zero_copy': settings.zero_copy,
+            'chunk_size': settings.min_chunk_size,
+            'max_chunk_size': settings.max_chunk_size,
+            'digest': settings.digest(repo),
+            'dedup': settings.dedup(repo)}
+
+
+def download_job(status, directory, repo):
+    """Download file of status in worker thread. Errors are saved to status, so other downloads go on"""
+    try:
+        local_file = download_file(status.url, directory, status.filename, status, **download_options(repo))
+        record_download(repo, status.filename, local_file)
+    except (EnvironmentError,) + NETWORK_ERRORS as e:
+        logging.exception("Failed to download %s", status.url)
+        record_local_file(os.path.join(directory, status.filename), STATUS_PARTIAL)
+        status.error = e
+        status.state = status.FAILED
+    else:
+        status.percent = 100
+        status.state = status.SUCCEEDED
+
+
+def download_files(dialog, jobs, repo):
+    """Download files one by one showing gauge of every file
+    :param dialog: dialog object
+    :param jobs: list of tuples (url, filename)
+    :param repo: name of repo, which files are downloaded
+    """
+    directory = settings.download_path
+    gauge = GaugeReporter(dialog, min_interval=settings.gauge_interval)
+    for url, fname in jobs:
+        try:
+            local_file = download_file(url, directory, fname, gauge, **download_options(repo))
+            record_download(repo, fname, local_file)
+        except (EnvironmentError,) + NETWORK_ERRORS as e:
+            logging.exception("Failed to download %s", url)
+            record_local_file(os.path.join(directory, fname), STATUS_PARTIAL)
+            dialog.msgbox("Failed to download {}: {}".format(fname, e))
+
+
+def download_files_parallel(dialog, jobs, repo, workers, poll_interval=0.5, max_shown=10):
+    """Download several files at once showing combined progress and status of every file
+    :param dialog: dialog object
+    :param jobs: list of tuples (url, filename)
+    :param repo: name of repo, which files are downloaded
+    :param workers: count of files downloaded at once
+    :param poll_interval: how often progress is redrawn, seconds
+    :param max_shown: how many files fit into progress dialog
+    """
+    directory = settings.download_path
+    statuses = [DownloadStatus(url, fname) for url, fname in jobs]
+    queue = ThreadPool(workers)
+    try:
+        results = [queue.apply_async(download_job, (status, directory, repo)) for status in statuses]
+        while True:
+            is_done = all(result.ready() for result in results)
+            finished_count = sum(1 for status in statuses if status.is_finished)
+            percent = sum(status.percent for status in statuses) // len(statuses)
+            # Files in progress and failed ones are the most interesting, show them first
+            shown = sorted(statuses, key=lambda status: (status.state != status.RUNNING,
+                                                         status.state != status.FAILED))[:max_shown]
+            dialog.mixedgauge("Downloaded {} of {} files".format(finished_count, len(statuses)),
+                              percent=percent,
+                              elements=[(status.filename, status.item) for status in shown])
+            if is_done:
+                break
+            time.sleep(poll_interval)
+        for result in results:
+            # Download errors are kept in statuses, so here are only unexpected ones
+            result.get()
+    finally:
+        queue.close()
+        queue.join()
+    failed = [status for status in statuses if status.state == status.FAILED]
+    if failed:
+        dialog.msgbox("Failed to download:\n" + "\n".join("{}: {}".format(status.filename, status.error)
+                                                            for status in failed))
+
+
+def process_filelist(dialog, url_list, repo, diff=None):
     """Recursively process list of urls. The recursion is just for convenience of user dialogs
     :param dialog: dialog object
     :param url_list: list of urls to process
+    :param repo: name of repo, which files are processed
+    :param diff: ListingDiff of repo. None if it is not compared with last visit yet
     """
-    file_urls = [(filename, url) for filename, url in url_list if not is_file_exists(filename)]
+    states = local_states([filename for filename, _ in url_list])
+    if diff is None:
+        diff = refresh_snapshot(dialog, repo, url_list)
+    verify_sizes(states, url_list)
+    # Files changed in repo are offered again even if they were downloaded
+    file_urls = [(filename, url) for filename, url in url_list
+                 if not is_downloaded(states[filename]) or filename in diff.changed]
     if file_urls:
-        download_urls = choose_files(file_urls, dialog)
-        if download_urls:
-            for url in download_urls:
-                directory = settings.download_path
-                fname = next(f for f, u in file_urls if u == url)
-                download_file(url, directory, fname, dialog)
+        prefetch_remote_info(dialog, [url for _, url in file_urls])
+        download_urls = choose_files(file_urls, dialog, diff, states)
+        if download_urls and not confirm_download(dialog, download_urls):
+            process_filelist(dialog, url_list, repo, diff)
+        elif download_urls:
+            jobs = [(url, next(f for f, u in file_urls if u == url)) for url in download_urls]
+            if not make_room(dialog, jobs, repo):
+                process_filelist(dialog, url_list, repo, diff)
+                return
+            workers = settings.max_parallel_downloads
+            if workers > 1 and len(jobs) > 1:
+                download_files_parallel(dialog, jobs, repo, workers)
+            else:
+                download_files(dialog, jobs, repo)
+            diff = ListingDiff(diff.added, diff.removed, diff.changed - set(filename for _, filename in jobs))
             # This recursion is just for convenience of user dialogs
             if dialog.yesno("All files downloaded. Want to choose more?") == dialog.DIALOG_OK:
-                process_filelist(dialog, url_list)
+                process_filelist(dialog, url_list, repo, diff)
     else:
         dialog.msgbox("Nothing to download")
 
 
 def choose_repo(repos, dialog):
-    """Choose repo from repos list via dialog"""
+    """Choose repo from repos list via dialog. Returns tuple (name, uri) or None"""
     dialog_result = dialog.menu("Choose repo", choices=repos, cancel_label="Exit")
     if dialog_result[0] == dialog.DIALOG_OK:
-        return next((uri for name, uri in repos if name == dialog_result[1]))
+        return next(((name, uri) for name, uri in repos if name == dialog_result[1]))
     else:
         return None
 
 
-def process_repos(dialog, repos):
+def fetch_page(page_url, parser_class=DropboxParser):
+    """Download and parse one page of shared folder. Page is parsed by chunks while it is downloaded.
+    Cached result is used if page was not changed since it was parsed.
+    If result of parser looks wrong, page is downloaded again and parsed by DropboxParser
+    :param parser_class: factory of parser to use
+    :return: tuple (list of fileinfos, list of folderinfos) or None if page is not available
+    """
+    logging.debug("Downloading filelist from %s", page_url)
+    started = time.time()
+    cached = listing_cache.load(page_url, page_format(parser_class))
+    headers = ListingCache.conditional_headers(cached)
+    try:
+        while True:
+            try:
+                with pool.request('GET', page_url, headers=headers) as response:
+                    if response.status == 304 and cached:
+                        logging.debug("Filelist of %s is not modified, %d cached file links", page_url,
+                                      len(cached.file_infos))
+                        return cached.file_infos, cached.folders
+                    if response.status != 200:
+                        logging.error("Failed to download filelist from %s: %d %s", page_url, response.status,
+                                      response.reason)
+                        return None
+                    with parser_class(page_url) as parser:
+                        for number, _ in enumerate(parser.feed_stream(response)):
+                            if not number:
+                                logging.debug("First file link found in %.2fs", time.time() - started)
+                    etag, last_modified = response.getheader('ETag'), response.getheader('Last-Modified')
+            except NETWORK_ERRORS:
+                raise
+            except Exception:
+                if parser_class is DropboxParser:
+                    logging.exception("Failed to parse filelist from %s", page_url)
+                    return None
+                logging.exception("Failed to parse %s, it is parsed by DropboxParser", page_url)
+                parser_class, headers = DropboxParser, {}
+                continue
+            if parser.looks_valid() or parser_class is DropboxParser:
+                break
+            logging.warning("Links found in %s look wrong, it is parsed by DropboxParser", page_url)
+            parser_class, headers = DropboxParser, {}
+        listing_cache.save(page_url, page_format(parser_class), etag, last_modified, parser.data,
+                           parser.folders)
+        if cached is not None:
+            # Page is changed, so files of it may be changed too, even if their links stay the same.
+            # Links which disappeared from page are forgotten as well
+            links = set(link for _, link in cached.file_infos)
+            links.update(link for _, link in parser.data)
+            remote_info.forget(links)
+    except NETWORK_ERRORS:
+        logging.exception("Failed to download filelist from %s", page_url)
+        return None
+    logging.debug("Found %d file links and %d folders in %.2fs", len(parser.data), len(parser.folders),
+                  time.time() - started)
+    return parser.data, parser.folders
+
+
+def fetch_filelist(filelist_url, max_depth=0, workers=1, parser_class=DropboxParser):
+    """Download and parse filelist of shared folder and, if max_depth allows, of its subfolders.
+    Subfolders of one level are fetched at once by workers threads.
+    Filename of file in subfolder is its path relative to shared folder
+    :param max_depth: how many levels of subfolders are crawled. Zero means only shared folder itself
+    :param workers: count of pages requested at once
+    :param parser_class: factory of parser for pages
+    :return: Listing of fileinfos or None if filelist of shared folder is not available
+    """
+    fetch = partial(fetch_page, parser_class=parser_class)
+    page = fetch(filelist_url)
+    if page is None:
+        return None
+    file_infos, folders = page
+    if not max_depth or not folders:
+        return file_infos
+    # Copy, listing of shared folder is cached and mustn't be changed
+    file_infos = Listing(file_infos)
+    visited = {filelist_url}
+    level = [(folder.name, folder.link) for folder in folders]
+    depth = 1
+    crawler = None
+    try:
+        while level and depth <= max_depth:
+            level = [(prefix, link) for prefix, link in level if link not in visited]
+            visited.update(link for _, link in level)
+            if not level:
+                break
+            if crawler is None:
+                crawler = ThreadPool(max(1, workers))
+            next_level = []
+            for (prefix, link), page in zip(level, crawler.imap(fetch, [link for _, link in level])):
+                if page is None:
+                    logging.warning("Subfolder %s is skipped", prefix)
+                    continue
+                sub_infos, sub_folders = page
+                file_infos.extend(FileInfo(prefix + '/' + info.filename, info.link) for info in sub_infos)
+                next_level.extend((prefix + '/' + folder.name, folder.link) for folder in sub_folders)
+            level = next_level
+            depth += 1
+    finally:
+        if crawler is not None:
+            crawler.close()
+    logging.debug("Found %d file links in %d folders", len(file_infos), len(visited))
+    return file_infos
+
+
+def fetch_repo(name, url):
+    """Filelist of repo, crawled as deep as it is set for repo"""
+    return fetch_filelist(url, settings.max_depth(name), settings.crawl_workers(name),
+                          settings.parser(name, url))
+
+
+class FilelistPrefetch(object):
+    """Filelists of repos fetched and parsed by background threads,
+    so they are ready by the time user chooses repo"""
+
+    def __init__(self, repos, is_enabled=True):
+        """
+        :param repos: list of tuples (name, url)
+        :param is_enabled: start fetching all filelists at once. Otherwise they are fetched on demand
+        """
+        self._queue = None
+        self._results = {}
+        if is_enabled and repos:
+            self._queue = ThreadPool(len(repos))
+            self._results = dict((repo, self._queue.apply_async(fetch_repo, repo)) for repo in repos)
+
+    def is_ready(self, repo):
+        result = self._results.get(repo)
+        return result is not None and result.ready()
+
+    def get(self, repo):
+        """Filelist of repo like fetch_repo gives. Waits if it is still being fetched.
+        Prefetched filelist is given once, it is fetched again when asked next time
+        :param repo: tuple (name, url)
+        """
+        result = self._results.pop(repo, None)
+        return fetch_repo(*repo) if result is None else result.get()
+
+    def close(self):
+        if self._queue is not None:
+            self._queue.close()
+
+
+def process_repos(dialog, repos, filelists):
     """
     Recursively choose repo and start processing.
     The recursion is just for convenience of user dialogs
+    :param filelists: FilelistPrefetch of repos
     """
     if len(repos) == 1:
-        filelist_url = repos[0][1]
+        repo = repos[0]
     else:
-        filelist_url = choose_repo(repos, dialog)
-    if not filelist_url:
+        repo = choose_repo(repos, dialog)
+    if not repo:
         dialog.msgbox("OK! Bye!")
         return
-    dialog.infobox("Requesting filelist...")
-    logging.debug("Downloading filelist from %s", filelist_url)
-    process = subprocess.Popen('wget --no-check-certificate -qO- ' + filelist_url,
-                               stdout=subprocess.PIPE,
-                               shell=True)
-    content = process.stdout.read()
-    if not content:
+    repo_name, _ = repo
+    if not filelists.is_ready(repo):
+        dialog.infobox("Requesting filelist...")
+    file_infos = filelists.get(repo)
+    if file_infos is None:
         dialog.msgbox("No filelist! Check internet connection!")
         return
-    with DropboxParser() as parser:
-        parser.feed(content)
-        logging.debug("Found %d file links", len(parser.data))
-        process_filelist(dialog, parser.data)
+    process_filelist(dialog, file_infos, repo_name)
     if len(repos) != 1 and dialog.yesno("Choose another repo?", no_label="Exit") == dialog.DIALOG_OK:
-        process_repos(dialog, repos)
+        process_repos(dialog, repos, filelists)
 
 
 def main():
+    repos = settings.repos
+    filelists = FilelistPrefetch(repos, settings.prefetch_listings)
     dialog = Dialog()
     dialog.add_persistent_args(["--backtitle", "ZiNC is Not a Cloud. v%s" % __version__])
-    repos = settings.repos
-    process_repos(dialog, repos)
+    process_repos(dialog, repos, filelists)
+    filelists.close()
+    pool.close()
+    index.close()
 
 
 if __name__ == '__main__':
     settings = Settings()
+    pool = ConnectionPool(timeout=settings.timeout)
+    index = MetadataIndex(settings.index_path)
+    remote_info = RemoteInfoCache(pool, index)
+    listing_cache = ListingCache(index)
+    inventory = LocalInventory(settings.download_path)
     log_level = logging.DEBUG if settings.do_logging else logging.CRITICAL
     log_filepath = os.path.join(settings.app_home_directory, 'zinc.log')
     logging.basicConfig(filename=os.path.expanduser(log_filepath),